@@ -1,9 +1,11 @@
+import os
 from os import environ, path
 
+import botocore
 import dotenv
-from pytest import mark
+from pytest import mark, raises
 
-from transcribe import aws
+from transcribe import aws, cache
 
 dotenv.load_dotenv()
 
@@ -41,3 +43,119 @@ def test_transcript_fr():
         == "Il s'agit d'un test de lecture de Whisper en français."
     )
     assert result["results"]["language_code"] == "fr-FR"
+
+
+class StubClient:
+    """
+    A stand-in for the boto3 s3 and transcribe clients which completes each
+    transcription job after it has been polled a few times.
+    """
+
+    def __init__(self):
+        self.uploads = []
+        self.objects = {}
+        self.jobs = {}
+
+    def create_bucket(self, **kwargs):
+        pass
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404"}}, "HeadObject"
+            )
+        return self.objects[Key]
+
+    def upload_file(self, path, bucket_name, key, ExtraArgs={}, Config=None):
+        self.uploads.append(key)
+        self.objects[key] = {
+            "ContentLength": os.path.getsize(path),
+            "ETag": '"abc123-2"',
+            "Metadata": ExtraArgs.get("Metadata", {}),
+        }
+
+    def start_transcription_job(self, TranscriptionJobName, Media, **kwargs):
+        self.jobs[TranscriptionJobName] = {"media": Media["MediaFileUri"], "polls": 0}
+
+    def get_transcription_job(self, TranscriptionJobName):
+        job = self.jobs[TranscriptionJobName]
+        job["polls"] += 1
+        # every job has been started before any are polled
+        assert len(self.jobs) == 2
+        status = "COMPLETED" if job["polls"] >= 3 else "IN_PROGRESS"
+        return {
+            "TranscriptionJob": {
+                "TranscriptionJobName": TranscriptionJobName,
+                "TranscriptionJobStatus": status,
+                "Transcript": {"TranscriptFileUri": job["media"]},
+            }
+        }
+
+
+def test_run_concurrently(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    client = StubClient()
+    monkeypatch.setattr(aws, "get_client", lambda service_name: client)
+    monkeypatch.setattr(aws.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(
+        aws,
+        "fetch_transcript",
+        lambda job: {
+            "results": {
+                "language_code": "en-US",
+                "transcripts": [
+                    {"transcript": "This is a test for whisper reading in English."}
+                ],
+            }
+        },
+    )
+
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "druid,media_filename,media_language,transcript_filename,transcript_language\n"
+        f"aa111aa1111,{TEST_DATA}/en.wav,en,{TEST_DATA}/en.txt,en\n"
+        f"bb222bb2222,{TEST_DATA}/fr.wav,fr,{TEST_DATA}/en.txt,en\n"
+        f"cc333cc3333,{TEST_DATA}/fr.wav,en,{TEST_DATA}/en.vtt,en\n"
+    )
+    aws.run(str(tmp_path), str(manifest), concurrency=2)
+
+    assert sorted(client.uploads) == ["en.wav", "fr.wav"]
+    report = (tmp_path / "report-aws.csv").read_text().splitlines()
+    assert len(report) == 3
+    assert report[1].startswith("aa111aa1111-aws-001,")
+    assert report[2].startswith("cc333cc3333-aws-002,")
+
+
+def test_wait_for_job_failed(monkeypatch):
+    monkeypatch.setattr(aws.time, "sleep", lambda seconds: None)
+
+    class FailingClient:
+        def get_transcription_job(self, TranscriptionJobName):
+            return {
+                "TranscriptionJob": {
+                    "TranscriptionJobName": TranscriptionJobName,
+                    "TranscriptionJobStatus": "FAILED",
+                    "FailureReason": "unsupported media",
+                }
+            }
+
+    metrics = {}
+    with raises(RuntimeError, match="unsupported media"):
+        aws.wait_for_job(FailingClient(), "job", metrics)
+    assert metrics["polls"] == 1
+
+
+def test_upload_file_unchanged(monkeypatch):
+    client = StubClient()
+    monkeypatch.setattr(aws, "get_client", lambda service_name: client)
+
+    wav = path.join(TEST_DATA, "en.wav")
+    uri = aws.upload_file(wav)
+    assert uri.endswith("/en.wav")
+    assert aws.upload_file(wav) == uri
+    assert client.uploads == ["en.wav"]
+
+    # a different file with the same name is uploaded again
+    client.objects["en.wav"]["Metadata"]["sha256"] = "something else"
+    aws.upload_file(wav)
+    assert client.uploads == ["en.wav", "en.wav"]
@@ -0,0 +1,36 @@
+from transcribe import benchmark, pcm, whisper
+
+
+def test_run():
+    results = benchmark.run(duration=5, words=100, repeats=2)
+
+    assert list(results["stages"]) == benchmark.stages
+    for result in results["stages"].values():
+        assert len(result["times"]) == 2
+        assert result["best"] == min(result["times"])
+    assert results["stages"]["transcribe"]["rtf"] > 0
+
+
+def test_compare():
+    baseline = {"stages": {"decode": {"best": 1.0}, "compare": {"best": 2.0}}}
+    results = {"stages": {"decode": {"best": 1.1}, "compare": {"best": 3.0}}}
+
+    assert benchmark.compare(results, baseline) == [
+        ("decode", 1.0, 1.1, 1.1, False),
+        ("compare", 2.0, 3.0, 1.5, True),
+    ]
+
+
+def test_synthetic_audio():
+    audio = benchmark.synthetic_audio(30)
+    assert len(audio) == 30 * pcm.SAMPLE_RATE
+
+    # there are pauses to split the audio at
+    assert len(whisper.find_silences(audio)) > 0
+
+
+def test_synthetic_transcripts():
+    reference, hypothesis = benchmark.synthetic_transcripts(120, line_length=12)
+    assert len(reference) == 10
+    assert sum(len(line.split()) for line in reference) == 120
+    assert reference != hypothesis
@@ -0,0 +1,55 @@
+import threading
+from os import path
+
+import pytest
+
+from transcribe import daemon, whisper
+
+TEST_DATA = path.join(path.dirname(__file__), "data")
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    transcribed = []
+
+    def fake_transcribe(file_metadata, options, metrics=None, use_daemon=True):
+        if file_metadata["media_filename"].endswith("missing.wav"):
+            raise FileNotFoundError(file_metadata["media_filename"])
+        transcribed.append((file_metadata, options, use_daemon))
+        metrics["inference_time"] = 1.0
+        return {"text": "hello", "segments": [], "language": "en"}
+
+    monkeypatch.setattr(whisper, "transcribe", fake_transcribe)
+
+    socket_path = str(tmp_path / "daemon.sock")
+    server = daemon.make_server(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield socket_path, transcribed
+    server.shutdown()
+    server.server_close()
+
+
+def test_request(server):
+    socket_path, transcribed = server
+    wav = path.relpath(path.join(TEST_DATA, "en.wav"))
+    file_metadata = {"media_filename": wav, "media_language": "en"}
+    options = {"model_name": "tiny", "beam_size": 5}
+
+    metrics = {}
+    transcription = daemon.request(socket_path, file_metadata, options, metrics)
+    assert transcription["text"] == "hello"
+    assert metrics == {"inference_time": 1.0}
+
+    # the daemon transcribes the file itself, using an absolute path
+    assert len(transcribed) == 1
+    sent_metadata, sent_options, use_daemon = transcribed[0]
+    assert sent_metadata["media_filename"] == path.join(TEST_DATA, "en.wav")
+    assert sent_options == options
+    assert use_daemon is False
+
+
+def test_request_error(server):
+    socket_path, _ = server
+    with pytest.raises(RuntimeError, match="FileNotFoundError"):
+        daemon.request(socket_path, {"media_filename": "missing.wav"}, {})
@@ -1,6 +1,9 @@
+import io
 import os
+from types import SimpleNamespace
 
 import dotenv
+import pytest
 from pytest import mark
 
 from transcribe import google, utils
@@ -40,14 +43,43 @@ def test_transcript_fr():
 
 
 @mark.skipif(NO_GOOGLE, reason="no Google keys")
-def test_copy_file():
+def test_copy_flac():
+    filename = utils.file_hash("test/data/en.wav") + ".flac"
     assert (
-        google.copy_file("test/data/en.wav")
-        == "gs://sul-dlss-transcription-edsu-test/en.wav"
+        google.copy_flac("test/data/en.wav")
+        == f"gs://sul-dlss-transcription-edsu-test/{filename}"
     )
 
 
-def test_convert_to_wav():
-    path = google.convert_to_wav("test/data/en.wav")
-    assert path.endswith(".wav")
-    assert os.path.getsize(path) > 0
+def test_copy_flac_error(monkeypatch, tmp_path):
+    class Writer(io.BytesIO):
+        def __exit__(self, exc_type, *args):
+            # a BlobWriter only commits the upload when closed without an error
+            self.committed = exc_type is None
+            return super().__exit__(exc_type, *args)
+
+    writer = Writer()
+    bucket = SimpleNamespace(
+        get_blob=lambda filename: None,
+        blob=lambda filename: SimpleNamespace(open=lambda *args, **kwargs: writer),
+    )
+    monkeypatch.setattr(google, "get_bucket", lambda bucket_name: bucket)
+
+    media_file = tmp_path / "broken.wav"
+    media_file.write_bytes(b"not audio")
+    with pytest.raises(RuntimeError):
+        google.copy_flac(str(media_file))
+    assert writer.committed is False
+
+
+def test_convert_to_flac():
+    with google.convert_to_flac("test/data/en.wav") as flac:
+        data = flac.read()
+    assert data.startswith(b"fLaC")
+    assert len(data) < os.path.getsize("test/data/en.wav")
+
+
+def test_convert_to_flac_error():
+    with pytest.raises(RuntimeError):
+        with google.convert_to_flac("test/data/missing.wav") as flac:
+            flac.read()
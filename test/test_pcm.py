@@ -0,0 +1,261 @@
+import multiprocessing
+import time
+from os import path
+
+import numpy
+import pytest
+from pytest import approx
+
+from transcribe import cache, pcm
+
+TEST_DATA = path.join(path.dirname(__file__), "data")
+
+
+def test_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    wav = path.join(TEST_DATA, "en.wav")
+
+    audio = pcm.load(wav)
+    assert audio.dtype == numpy.float32
+    assert isinstance(audio, numpy.memmap)
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 1
+
+    # the second load comes from the cache
+    assert numpy.array_equal(pcm.load(wav), audio)
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 1
+
+    # a filter chain is cached separately
+    louder = pcm.load(wav, "volume=2")
+    assert len(louder) == len(audio)
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 2
+
+
+def test_prune(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    array = numpy.zeros(1000, dtype=numpy.float32)
+    cache.save("test", "a", array)
+    time.sleep(0.1)
+    cache.save("test", "b", array)
+    time.sleep(0.1)
+
+    # loading a makes b the least recently used
+    cache.load("test", "a")
+    time.sleep(0.1)
+    size = path.getsize(cache.get_path("test", "a"))
+    cache.save("test", "c", array, max_bytes=size * 2)
+
+    assert cache.load("test", "a") is not None
+    assert cache.load("test", "b") is None
+    assert cache.load("test", "c") is not None
+
+
+def test_prune_stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    array = numpy.zeros(1000, dtype=numpy.float32)
+    cache.save("audio", "a", array)
+    time.sleep(0.1)
+    cache.save("features", "b", array)
+    time.sleep(0.1)
+
+    # the size limit is for all the stores together
+    size = path.getsize(cache.get_path("audio", "a"))
+    cache.save("features", "c", array, max_bytes=size * 2)
+
+    assert cache.load("audio", "a") is None
+    assert cache.load("features", "b") is not None
+    assert cache.load("features", "c") is not None
+
+
+def test_prune_json(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    data = {"words": ["word"] * 100}
+    cache.save_json("test", "a", data)
+    time.sleep(0.1)
+    cache.save_json("test", "b", data)
+    time.sleep(0.1)
+
+    # loading a makes b the least recently used
+    assert cache.load_json("test", "a") == data
+    time.sleep(0.1)
+    size = path.getsize(path.join(cache.get_dir("test"), "a.json"))
+    cache.save_json("test", "c", data, max_bytes=size * 2)
+
+    assert cache.load_json("test", "a") == data
+    assert cache.load_json("test", "b") is None
+    assert cache.load_json("test", "c") == data
+
+
+def test_load_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    cache.save("test", "a", numpy.arange(10))
+    cache.save_json("test", "b", {"words": []})
+
+    # another process may prune the file just after it is mapped
+    def pruned_utime(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(cache.os, "utime", pruned_utime)
+    assert numpy.array_equal(cache.load("test", "a"), numpy.arange(10))
+    assert cache.load_json("test", "b") == {"words": []}
+
+
+def test_load_too_big(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(cache, "MAX_BYTES", 100)
+
+    # audio that doesn't fit in the cache is still returned
+    audio = pcm.load(path.join(TEST_DATA, "en.wav"))
+    assert audio is not None
+    assert len(audio) > 100
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 0
+
+    array = cache.save("test", "a", numpy.zeros(1000), max_bytes=100)
+    assert numpy.array_equal(array, numpy.zeros(1000))
+
+
+def test_stream_verbose(monkeypatch):
+    wav = path.join(TEST_DATA, "en.wav")
+    audio = pcm.decode(wav)
+
+    # ffmpeg writing more to stderr than a pipe holds mustn't block it
+    monkeypatch.setattr(
+        pcm, "ffmpeg_command", lambda file: ["ffmpeg", "-nostdin", "-i", file]
+    )
+    verbose = pcm.decode(wav, "asetnsamples=n=16,ashowinfo")
+    assert len(verbose) == len(audio)
+
+
+def test_detect_silences():
+    # one second of noise, one second of silence and then noise again
+    audio = numpy.concatenate(
+        [numpy.full(16000, 0.5), numpy.zeros(16000), numpy.full(8000, 0.5)]
+    ).astype(numpy.float32)
+    assert pcm.mean_volume(audio) == approx(-8.24, abs=0.01)
+
+    silences = pcm.detect_silences(audio, -30)
+    assert silences.tolist() == [(1.0, 2.0, 1.0)]
+
+    # a silence shorter than the minimum duration is ignored
+    assert len(pcm.detect_silences(audio, -30, min_duration=1.5)) == 0
+
+    # trailing silence ends at the end of the audio
+    silences = pcm.detect_silences(audio[0:32000], -30)
+    assert silences.tolist() == [(1.0, 2.0, 1.0)]
+
+
+def test_load_filtered(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    wav = path.join(TEST_DATA, "en.wav")
+    filter_chains = ["volume=2", "highpass=200,lowpass=3000"]
+
+    # a single ffmpeg decode gives the same audio as separate decodes
+    results = pcm.load_filtered(wav, filter_chains)
+    assert len(results) == 2
+    for filters, audio in zip(filter_chains, results):
+        assert numpy.array_equal(audio, pcm.decode(wav, filters))
+
+    # and they are in the cache for load
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 2
+    assert numpy.array_equal(pcm.load(wav, "volume=2"), results[0])
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 2
+
+
+def test_load_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    wav = path.join(TEST_DATA, "en.wav")
+
+    # the processes share the count of decodes through a file
+    decodes = tmp_path / "decodes"
+    stream = pcm.stream
+
+    def counting_stream(file, filters=None):
+        with open(decodes, "a") as fh:
+            fh.write("decode\n")
+        return stream(file, filters)
+
+    monkeypatch.setattr(pcm, "stream", counting_stream)
+
+    # processes asking for the same file at once wait for the first to decode it
+    context = multiprocessing.get_context("fork")
+    with context.Pool(4) as pool:
+        results = pool.map(pcm.load, [wav] * 4)
+    assert decodes.read_text() == "decode\n"
+    assert all(len(audio) == len(results[0]) for audio in results)
+
+
+def test_load_filtered_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    wav = path.join(TEST_DATA, "en.wav")
+    filter_chains = ["volume=2", "highpass=200,lowpass=3000"]
+
+    # the processes share the count of decodes through a file
+    decodes = tmp_path / "decodes"
+    decode_filtered = pcm.decode_filtered
+
+    def counting_decode_filtered(file, filter_chains):
+        with open(decodes, "a") as fh:
+            fh.write(f"{len(filter_chains)}\n")
+        return decode_filtered(file, filter_chains)
+
+    monkeypatch.setattr(pcm, "decode_filtered", counting_decode_filtered)
+
+    # processes asking for the same file at once wait for the first to decode it
+    context = multiprocessing.get_context("fork")
+    with context.Pool(4) as pool:
+        results = pool.starmap(pcm.load_filtered, [(wav, filter_chains)] * 4)
+    assert decodes.read_text() == "2\n"
+    assert all(len(audio) == len(results[0][0]) for audio, _ in results)
+
+
+def test_load_filtered_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    media_file = tmp_path / "broken.wav"
+    media_file.write_bytes(b"not audio")
+
+    # none of the outputs are cached when ffmpeg fails
+    with pytest.raises(RuntimeError):
+        pcm.load_filtered(str(media_file), ["volume=2", "volume=3", "volume=4"])
+    assert len(list((tmp_path / "audio").glob("*.npy"))) == 0
+
+
+def test_stream(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    wav = path.join(TEST_DATA, "en.wav")
+
+    # the blocks are all the same size except the last one
+    blocks = list(pcm.stream(wav, block_size=16000))
+    assert len(blocks) > 1
+    assert all(len(block) == 16000 for block in blocks[:-1])
+    assert 0 < len(blocks[-1]) <= 16000
+
+    # and together they are the decoded audio
+    audio = pcm.decode(wav)
+    assert numpy.array_equal(numpy.concatenate(blocks), audio)
+
+    # which can be written to the cache a block at a time
+    cached = cache.save_blocks("audio", "a", iter(blocks))
+    assert isinstance(cached, numpy.memmap)
+    assert numpy.array_equal(cached, audio)
+
+
+def test_stream_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        list(pcm.stream(str(tmp_path / "missing.wav")))
+
+
+def test_detect_silences_blocks():
+    # silences that cross block boundaries are the same as with one block
+    audio = numpy.concatenate(
+        [
+            numpy.full(12000, 0.5),
+            numpy.zeros(20000),
+            numpy.full(5000, 0.5),
+            numpy.zeros(9000),
+        ]
+    ).astype(numpy.float32)
+
+    expected = pcm.detect_silences(audio, -30)
+    assert len(expected) == 2
+    for block_size in [1000, 7000, 12000, 16000]:
+        silences = pcm.detect_silences(audio, -30, block_size=block_size)
+        assert silences.tolist() == expected.tolist()
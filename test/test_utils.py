@@ -1,7 +1,10 @@
 import tempfile
 from os import path
 
-from transcribe import utils
+import jiwer
+import pytest
+
+from transcribe import cache, utils
 
 TEST_DATA = path.join(path.dirname(__file__), "data")
 
@@ -12,7 +15,26 @@ def test_get_data_files():
     assert path.basename(files[0]["media_filename"]) == "bb158br2509_sl.m4a"
 
 
-def test_compare_transcripts():
+def test_get_durations(tmp_path):
+    csv_path = tmp_path / "sdr-data.csv"
+    csv_path.write_text(
+        "Druid,Duration\n" "a,0:30:42\n" "b,1:02:03\n" "c,\n" "d,12:05\n"
+    )
+    assert utils.get_durations(csv_path) == {
+        "a": 1842.0,
+        "b": 3723.0,
+        "d": 725.0,
+    }
+
+    # the real spreadsheet has durations for every item
+    durations = utils.get_durations(
+        path.join(path.dirname(TEST_DATA), "..", "sdr-data.csv")
+    )
+    assert durations["bb158br2509"] == 1842.0
+
+
+def test_compare_transcripts(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
     with tempfile.TemporaryDirectory() as output_dir:
         druid = "bb158br2509"
 
@@ -55,6 +77,14 @@ def test_compare_transcripts():
             path.join(output_dir, f"{druid}-whisper-001.html")
         ), "diff html written"
 
+        # the time spent in each stage is recorded if asked for
+        metrics = {}
+        utils.compare_transcripts(
+            file_metadata, whisper_transcript, "whisper", output_dir, metrics
+        )
+        assert set(metrics) == {"compare_time", "diff_time"}
+        assert all(seconds > 0 for seconds in metrics.values())
+
 
 def test_read_txt_reference_file():
     lines = utils.read_reference_file(path.join(TEST_DATA, "en.txt"))
@@ -90,3 +120,109 @@ def test_split_sentences():
     assert utils.split_sentences(
         ["Hiya.\n This is a test? This is another test... Onwards.\n", ""]
     ) == ["Hiya.", "This is a test?", "This is another test...", "Onwards."]
+
+
+def test_ledger():
+    with tempfile.TemporaryDirectory() as output_dir:
+        assert utils.read_ledger(output_dir) == {}
+
+        key = utils.ledger_key("bb158br2509", "whisper", {"model_name": "large"})
+        utils.append_ledger(output_dir, key, {"run_id": "bb158br2509-whisper-001"})
+
+        # simulate a run that was killed while writing
+        with open(path.join(output_dir, "ledger.jsonl"), "a") as fh:
+            fh.write('{"key": ')
+
+        assert utils.read_ledger(output_dir) == {
+            key: {"run_id": "bb158br2509-whisper-001"}
+        }
+
+
+def test_poll(monkeypatch):
+    delays = []
+    monkeypatch.setattr(utils.time, "sleep", delays.append)
+
+    responses = iter([None] * 8 + ["done"])
+    metrics = {}
+    assert utils.poll(lambda: next(responses), metrics=metrics, cap=30) == "done"
+
+    assert len(delays) == 8
+    assert 0.9 <= delays[0] <= 1.1
+    assert 27 <= delays[-1] <= 33
+    assert metrics["polls"] == 9
+    assert metrics["poll_wait"] == sum(delays)
+
+
+def test_poll_timeout(monkeypatch):
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+    metrics = {}
+    with pytest.raises(TimeoutError):
+        utils.poll(lambda: None, timeout=100, metrics=metrics)
+    assert metrics["poll_wait"] <= 100
+
+
+def test_poll_failure(monkeypatch):
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+
+    def check():
+        raise RuntimeError("job failed")
+
+    with pytest.raises(RuntimeError):
+        utils.poll(check)
+
+
+def test_word_stats():
+    reference = "the quick brown fox jumps over the lazy dog"
+    hypothesis = "the quick brown box jumps over lazy dog today"
+    stats = utils.word_stats(utils.token_ids(reference), utils.token_ids(hypothesis))
+
+    expected = jiwer.process_words(reference, hypothesis)
+    assert stats == {
+        "wer": expected.wer,
+        "mer": expected.mer,
+        "wil": expected.wil,
+        "wip": expected.wip,
+        "hits": expected.hits,
+        "substitutions": expected.substitutions,
+        "insertions": expected.insertions,
+        "deletions": expected.deletions,
+    }
+
+
+def test_write_diff():
+    with tempfile.TemporaryDirectory() as output_dir:
+        diff_path = path.join(output_dir, "diff.html")
+        html = utils.write_diff(
+            "bb158br2509",
+            ["- [Interviewer] To be or not to be. That is the question."],
+            ["To be or not to bee. That is the question. Extra <line>."],
+            diff_path,
+        )
+        assert open(diff_path).read() == html
+        assert "purl.stanford.edu/bb158br2509" in html
+        assert '<span class="diff_chg">be.</span>' in html
+        assert '<span class="diff_chg">bee.</span>' in html
+        assert '<span class="diff_add">Extra &lt;line&gt;.</span>' in html
+
+
+def test_load_reference(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    utils._load_reference.cache_clear()
+
+    reference = utils.load_reference(path.join(TEST_DATA, "en.vtt"))
+    assert reference["lines"] == ["This is a test for whisper reading in English."]
+    assert reference["words"] == "this is a test for whisper reading in english".split()
+    assert reference["sentences"] == ["This is a test for whisper reading in English."]
+    assert len(reference["ids"]) == 9
+    assert len(list((tmp_path / "references").glob("*.json"))) == 1
+
+    # other processes use the cached copy rather than parsing the file again
+    utils._load_reference.cache_clear()
+
+    def fail(path):
+        raise Exception("shouldn't be called")
+
+    monkeypatch.setattr(utils, "read_reference_file", fail)
+    assert utils.load_reference(path.join(TEST_DATA, "en.vtt"))["words"] == (
+        reference["words"]
+    )
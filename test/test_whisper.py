@@ -1,18 +1,33 @@
+import multiprocessing
+import os
+import threading
+import time
 from os import path
 
-from transcribe import whisper
+import numpy
+import pytest
+import torch
+from pytest import approx
+from whisper.tokenizer import get_tokenizer
+
+from transcribe import benchmark, cache, pcm, utils, whisper
 
 MODEL_SIZE = "small"
 TEST_DATA = path.join(path.dirname(__file__), "data")
 
 
 def test_get_silences():
-    assert whisper.get_silences(path.join(TEST_DATA, "en.wav")) == [
-        {"start_silence": 2.70731, "end_silence": 3.22, "duration": 0.512687}
-    ]
-    assert whisper.get_silences(path.join(TEST_DATA, "en-with-silence.wav")) == [
-        {"start_silence": 0.0, "end_silence": 35.1915, "duration": 35.1915}
-    ]
+    silences = whisper.get_silences(path.join(TEST_DATA, "en.wav"))
+    assert silences.dtype == pcm.SILENCE
+    assert len(silences) == 1
+    assert silences[0]["start"] == approx(2.70731)
+    assert silences[0]["end"] == approx(3.22)
+    assert silences[0]["duration"] == approx(0.512687)
+
+    silences = whisper.get_silences(path.join(TEST_DATA, "en-with-silence.wav"))
+    assert silences[0]["start"] == approx(0.0)
+    assert silences[0]["end"] == approx(35.1915, abs=0.01)
+    assert silences[0]["duration"] == approx(35.1915, abs=0.01)
 
 
 def test_get_language():
@@ -87,3 +102,533 @@ def test_whisper_option_combinations():
         "condition_on_previous_text": False,
         "best_of": 10,
     } in opts
+
+
+def test_plan_runs():
+    files = [{"druid": "a"}, {"druid": "b"}]
+    combinations = list(whisper.whisper_option_combinations())
+    runs = whisper.plan_runs(files, combinations)
+    assert len(runs) == 96
+
+    # each model is only loaded once
+    models = [options["model_name"] for _, options in runs]
+    assert models == ["medium"] * 32 + ["large"] * 32 + ["large-v3"] * 32
+
+    # run counts are the same as a file-major run
+    assert runs[0][0] == {"druid": "a", "run_count": 1}
+    assert runs[16][0] == {"druid": "b", "run_count": 49}
+    assert sorted(file_metadata["run_count"] for file_metadata, _ in runs) == list(
+        range(1, 97)
+    )
+
+
+def test_successive_halving():
+    files = [{"druid": druid} for druid in "abcd"]
+    combinations = list(whisper.whisper_option_combinations())
+    runs = whisper.plan_runs(files, combinations)
+
+    def wer(options):
+        # a unique best combination of options
+        return (
+            options["beam_size"]
+            + options["best_of"]
+            + options["patience"] / 10
+            + options["condition_on_previous_text"] / 100
+            + whisper.whisper_options["model_name"].index(options["model_name"]) / 1000
+        )
+
+    rungs = []
+
+    def execute_rung(rung_runs, desc):
+        rungs.append(rung_runs)
+        return [
+            {"run_id": file_metadata["run_count"], "wer": wer(options)}
+            for file_metadata, options in sorted(
+                rung_runs, key=lambda run: run[0]["run_count"]
+            )
+        ]
+
+    results = whisper.successive_halving(runs, execute_rung, eta=3)
+
+    # 48 combinations on 1 file, the best 16 on 2 more, and the best 6 on the last
+    assert [len(rung_runs) for rung_runs in rungs] == [48, 32, 6]
+    assert len(results) == 86
+    assert [result["run_id"] for result in results] == sorted(
+        result["run_id"] for result in results
+    )
+
+    best = min(combinations, key=wer)
+    assert {
+        file_metadata["druid"]
+        for file_metadata, options in runs
+        if options == best
+        and file_metadata["run_count"] in {result["run_id"] for result in results}
+    } == set("abcd")
+
+
+def test_order_runs():
+    files = [{"druid": "a"}, {"druid": "b"}, {"druid": "c"}]
+    combinations = [{"model_name": "medium"}, {"model_name": "large"}]
+    runs = whisper.plan_runs(files, combinations)
+
+    # c has no known duration so it is treated like the longest
+    durations = {"a": 60.0, "b": 600.0}
+    rtfs = {"medium": 0.1, "large": 0.5}
+    ordered = whisper.order_runs(runs, durations, rtfs)
+
+    assert [(run[1]["model_name"], run[0]["druid"]) for run in ordered] == [
+        ("large", "b"),
+        ("large", "c"),
+        ("large", "a"),
+        ("medium", "b"),
+        ("medium", "c"),
+        ("medium", "a"),
+    ]
+    # the run ids are unchanged
+    assert sorted(run[0]["run_count"] for run in ordered) == list(range(1, 7))
+
+
+def test_estimate_makespan():
+    # longest first packs the work better than shortest first
+    assert whisper.estimate_makespan([4, 1, 1], 2) == 4
+    assert whisper.estimate_makespan([1, 1, 4], 2) == 5
+    assert whisper.estimate_makespan([1, 2], 1) == 3
+
+
+def test_measure_rtfs(tmp_path):
+    options = {"model_name": "large"}
+    utils.append_ledger(
+        tmp_path,
+        utils.ledger_key("a", "whisper", options),
+        {"runtime": 30.0, "audio_duration": 60.0},
+    )
+    # older results without an audio_duration use the known durations
+    utils.append_ledger(
+        tmp_path, utils.ledger_key("b", "whisper", options), {"runtime": 90.0}
+    )
+    utils.append_ledger(tmp_path, utils.ledger_key("a", "aws"), {"runtime": 5.0})
+
+    rtfs = whisper.measure_rtfs([tmp_path], {"b": 120.0})
+    assert rtfs == {"large": 120.0 / 180.0}
+
+
+def test_execute_workers(monkeypatch, tmp_path):
+    loads = tmp_path / "loads.txt"
+
+    def fake_load_model(model_name, device):
+        with open(loads, "a") as fh:
+            fh.write(f"{model_name} {os.getpid()}\n")
+        return benchmark.random_model()
+
+    def fake_transcribe(file_metadata, options, metrics=None):
+        model = whisper.load_model(options["model_name"])
+        metrics.update({"audio_duration": 10.0, "inference_time": 2.0})
+        return {"pid": os.getpid(), "shared": model.encoder.conv1.weight.is_shared()}
+
+    def fake_compare_transcripts(file_metadata, transcription, *args):
+        return {"run_id": file_metadata["run_count"], **transcription}
+
+    monkeypatch.setattr(whisper.whisper, "load_model", fake_load_model)
+    monkeypatch.setattr(whisper, "models", {})
+    monkeypatch.setattr(whisper, "transcribe", fake_transcribe)
+    monkeypatch.setattr(whisper.utils, "compare_transcripts", fake_compare_transcripts)
+
+    files = [
+        {"druid": "a", "media_filename": "a.mp4"},
+        {"druid": "b", "media_filename": "b.mp4"},
+    ]
+    runs = whisper.plan_runs(files, list(whisper.whisper_option_combinations()))
+    results = whisper.execute(runs, str(tmp_path), workers=2)
+
+    # results come back in the original order from the worker processes
+    assert [result["run_id"] for result in results] == list(range(1, 97))
+    assert os.getpid() not in {result["pid"] for result in results}
+
+    # each model was loaded once, before the workers were forked, and they
+    # used that copy of it
+    assert loads.read_text().splitlines() == [
+        f"{model_name} {os.getpid()}" for model_name in ["medium", "large", "large-v3"]
+    ]
+    assert all(result["shared"] for result in results)
+
+    # with the profiling metrics from the worker
+    assert results[0]["rtf"] == 0.2
+    assert results[0]["write_time"] > 0
+    assert results[0]["peak_rss_mb"] > 0
+    assert results[0]["pss_mb"] <= results[0]["rss_mb"]
+    assert results[0]["worker_pid"] == results[0]["pid"]
+
+
+def test_execute_workers_error(monkeypatch, tmp_path):
+    def fake_transcribe(file_metadata, options, metrics=None):
+        if file_metadata["run_count"] == 3:
+            raise RuntimeError("unable to transcribe")
+        return {}
+
+    def fake_compare_transcripts(file_metadata, transcription, *args):
+        return {"run_id": file_metadata["run_count"]}
+
+    monkeypatch.setattr(whisper, "share_model", lambda model_name: None)
+    monkeypatch.setattr(whisper, "transcribe", fake_transcribe)
+    monkeypatch.setattr(whisper.utils, "compare_transcripts", fake_compare_transcripts)
+
+    runs = [
+        (
+            {"druid": str(i), "media_filename": f"{i}.mp4", "run_count": i},
+            {"model_name": "tiny"},
+        )
+        for i in range(1, 7)
+    ]
+    with pytest.raises(RuntimeError):
+        whisper.execute(runs, str(tmp_path), workers=2)
+
+    # the other runs are in the ledger so that they aren't run again
+    ledger = utils.read_ledger(str(tmp_path))
+    assert sorted(result["run_id"] for result in ledger.values()) == [1, 2, 4, 5, 6]
+
+
+def test_share_model(monkeypatch):
+    model = benchmark.random_model()
+    monkeypatch.setattr(whisper, "load_model", lambda model_name: model)
+    whisper.share_model("tiny")
+    # forked workers can only use CUDA if it isn't initialized before the fork
+    assert not torch.cuda.is_initialized()
+    if not torch.cuda.is_available():
+        assert all(p.is_shared() for p in model.parameters())
+
+
+def test_pipeline(monkeypatch, tmp_path):
+    prefetched = []
+    compared = []
+
+    def fake_load_audio(file, filters=None):
+        prefetched.append(file)
+
+    def fake_transcribe(file_metadata, options, metrics=None):
+        # the audio was decoded ahead of time
+        assert file_metadata["media_filename"] in prefetched
+        return {"file": file_metadata["media_filename"]}
+
+    def fake_compare_transcripts(file_metadata, transcription, *args):
+        compared.append(threading.current_thread())
+        return {"run_id": file_metadata["run_count"]}
+
+    monkeypatch.setattr(whisper, "load_audio", fake_load_audio)
+    monkeypatch.setattr(whisper, "transcribe", fake_transcribe)
+    monkeypatch.setattr(whisper.utils, "compare_transcripts", fake_compare_transcripts)
+
+    files = [
+        {"druid": "a", "media_filename": "a.mp4"},
+        {"druid": "b", "media_filename": "b.mp4"},
+    ]
+    runs = whisper.plan_runs(files, list(whisper.whisper_option_combinations()))
+    results = dict(whisper.pipeline(runs, str(tmp_path)))
+
+    assert sorted(results) == list(range(1, 97))
+    assert all(results[run_count]["run_id"] == run_count for run_count in results)
+
+    # each file is decoded once for each model, since the runs are model-major
+    assert prefetched == ["a.mp4", "b.mp4"] * 3
+
+    # and the results are written by the writer threads
+    assert threading.main_thread() not in compared
+    assert len(list(tmp_path.glob("*.json"))) == 96
+
+
+def test_pipeline_error(monkeypatch, tmp_path):
+    def fake_transcribe(file_metadata, options, metrics=None):
+        if file_metadata["run_count"] == 3:
+            raise RuntimeError("transcription failed")
+        return {}
+
+    def slow_compare_transcripts(file_metadata, transcription, *args):
+        time.sleep(0.1)
+        return {"run_id": file_metadata["run_count"]}
+
+    monkeypatch.setattr(whisper, "load_audio", lambda file, filters=None: None)
+    monkeypatch.setattr(whisper, "transcribe", fake_transcribe)
+    monkeypatch.setattr(whisper.utils, "compare_transcripts", slow_compare_transcripts)
+
+    runs = [
+        ({"druid": "a", "media_filename": "a.mp4", "run_count": i}, {})
+        for i in range(1, 5)
+    ]
+    finished = []
+    with pytest.raises(RuntimeError):
+        for run_count, _ in whisper.pipeline(runs, str(tmp_path)):
+            finished.append(run_count)
+
+    # the runs before the failure were still handed back
+    assert sorted(finished) == [1, 2]
+
+
+def test_execute_resume(monkeypatch, tmp_path):
+    transcribed = []
+
+    def fake_transcribe(file_metadata, options, metrics=None):
+        transcribed.append(file_metadata["run_count"])
+        return {}
+
+    def fake_compare_transcripts(file_metadata, transcription, *args):
+        return {"run_id": file_metadata["run_count"]}
+
+    monkeypatch.setattr(whisper, "transcribe", fake_transcribe)
+    monkeypatch.setattr(whisper.utils, "compare_transcripts", fake_compare_transcripts)
+
+    files = [{"druid": "a", "media_filename": "a.mp4"}]
+    runs = whisper.plan_runs(files, list(whisper.whisper_option_combinations()))
+    whisper.execute(runs[0:10], str(tmp_path))
+    assert len(transcribed) == 10
+
+    # only the runs that aren't in the ledger are run again
+    transcribed.clear()
+    results = whisper.execute(runs, str(tmp_path), resume=True)
+    assert len(transcribed) == 38
+    assert [result["run_id"] for result in results] == list(range(1, 49))
+
+
+def test_detect_languages(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    model = benchmark.random_model()
+    batches = []
+    detect_language = model.detect_language
+
+    def counting_detect_language(mel):
+        batches.append(mel.shape)
+        return detect_language(mel)
+
+    monkeypatch.setattr(model, "detect_language", counting_detect_language)
+    monkeypatch.setattr(whisper, "load_model", lambda model_name: model)
+
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "druid,media_filename\n"
+        f"a,{TEST_DATA}/en.wav\n"
+        f"b,{TEST_DATA}/fr.wav\n"
+        f"c,{TEST_DATA}/en.wav\n"
+    )
+    languages = whisper.detect_languages(str(manifest), "tiny", batch_size=2)
+
+    assert len(languages) == 3
+    assert languages[0] == languages[2]
+    assert batches == [(2, 80, 3000), (1, 80, 3000)]
+
+
+def test_speech_chunks():
+    silences = numpy.array(
+        [(0.0, 2.0, 2.0), (20.0, 21.0, 1.0), (40.0, 44.0, 4.0), (70.0, 75.0, 5.0)],
+        dtype=pcm.SILENCE,
+    )
+    chunks = whisper.speech_chunks(silences, 75.0)
+
+    # cut in the middle of silences, falling back to 30 second chunks, and
+    # leave out the trailing silence
+    assert chunks == [(0.0, 20.5), (20.5, 42.0), (42.0, 72.0)]
+
+
+def test_split_segments():
+    tokenizer = get_tokenizer(True, language="en")
+    text = tokenizer.encode(" Hello there.")
+    more = tokenizer.encode(" And more")
+    ts = tokenizer.timestamp_begin
+
+    segments = whisper.split_segments(
+        [ts, *text, ts + 100, ts + 100, *more, tokenizer.eot], tokenizer, 10.0
+    )
+    assert segments == [(0.0, 2.0, text), (2.0, 10.0, more)]
+
+    # text after a closed segment without a timestamp starts where it ended
+    segments = whisper.split_segments([ts, *text, ts + 250, *more], tokenizer, 10.0)
+    assert segments == [(0.0, 5.0, text), (5.0, 10.0, more)]
+
+
+def test_transcribe_batched(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        whisper, "load_model", lambda model_name: benchmark.random_model()
+    )
+    t = whisper.transcribe(
+        {
+            "media_filename": path.join(TEST_DATA, "en.wav"),
+            "media_language": "en",
+            "transcript_language": "en",
+        },
+        {"model_name": "tiny", "beam_size": 2, "batch_size": 4},
+    )
+    assert t["language"] == "en"
+    for segment in t["segments"]:
+        assert 0 <= segment["start"] <= segment["end"] <= 3.22
+
+
+def test_transcribe_chunks_beam_search():
+    model = benchmark.random_model()
+    audio = numpy.random.default_rng(0).normal(0, 0.1, 20 * pcm.SAMPLE_RATE)
+    chunks = [(0.0, 5.0), (5.0, 12.0), (12.0, 20.0)]
+
+    # decoding the chunks in batches gives the same results as one at a time
+    for language in ["en", None]:
+        results = [
+            whisper.transcribe_chunks(
+                model,
+                audio.astype(numpy.float32),
+                chunks,
+                batch_size,
+                language,
+                beam_size=2,
+            )
+            for batch_size in [1, 3]
+        ]
+        assert results[0]["text"] == results[1]["text"]
+
+
+def test_reuse_encoder(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    model = benchmark.random_model()
+    monkeypatch.setattr(whisper, "load_model", lambda model_name: model)
+
+    encoded = []
+    encoder_forward = model.encoder.forward
+
+    def counting_forward(mel):
+        encoded.append(len(mel))
+        return encoder_forward(mel)
+
+    monkeypatch.setattr(model.encoder, "forward", counting_forward)
+
+    # audio long enough to be transcribed in several chunks
+    media_file = str(tmp_path / "speech.wav")
+    benchmark.write_wav(media_file, benchmark.synthetic_audio(75))
+    file_metadata = {
+        "media_filename": media_file,
+        "media_language": "en",
+        "transcript_language": "en",
+    }
+    options = {"model_name": "tiny", "batch_size": 4}
+    expected = whisper.transcribe(file_metadata, {**options, "beam_size": 2})
+    windows = sum(encoded)
+    assert windows > 1
+    encoded.clear()
+
+    # the first run with the cache encodes every window, the rest reuse them
+    for beam_size in [2, 3, 2]:
+        options.update({"beam_size": beam_size, "reuse_encoder": True})
+        result = whisper.transcribe(file_metadata, options)
+        if beam_size == 2:
+            assert result["text"] == expected["text"]
+    assert sum(encoded) == windows
+
+    # and the model is back to normal when it isn't asked for
+    whisper.transcribe(file_metadata, {"model_name": "tiny", "batch_size": 4})
+    assert not isinstance(model.encoder, whisper.CachedEncoder)
+    assert sum(encoded) == 2 * windows
+
+    # or without batching, where the windows move with the decoded text
+    file_metadata["media_filename"] = path.join(TEST_DATA, "en.wav")
+    whisper.transcribe(
+        file_metadata, {"model_name": "tiny", "temperature": 0.0, "reuse_encoder": True}
+    )
+    assert not isinstance(model.encoder, whisper.CachedEncoder)
+
+
+def test_cached_encoder_processes(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    model = benchmark.random_model()
+
+    # the processes share the count of encoded windows through a file
+    encoded = tmp_path / "encoded"
+    encoder_forward = model.encoder.forward
+
+    def counting_forward(mel):
+        with open(encoded, "a") as fh:
+            fh.write(f"{len(mel)}\n")
+        return encoder_forward(mel)
+
+    monkeypatch.setattr(model.encoder, "forward", counting_forward)
+    encoder = whisper.CachedEncoder(model.encoder, "tiny")
+    mel = torch.randn(2, 80, 3000)
+
+    # workers encoding the same windows at once wait for the first of them
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=encoder, args=(mel,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert encoded.read_text() == "2\n"
+
+
+def test_load_model(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(whisper, "models", {})
+    monkeypatch.setattr(whisper, "MAX_MODELS", 2)
+    monkeypatch.setattr(
+        whisper.whisper, "load_model", lambda name, device: loaded.append(name) or name
+    )
+
+    # the least recently used model is dropped when there are too many
+    for model_name in ["tiny", "base", "tiny", "small", "tiny", "base"]:
+        assert whisper.load_model(model_name) == model_name
+    assert loaded == ["tiny", "base", "small", "base"]
+    assert list(whisper.models) == ["tiny", "base"]
+
+
+def test_load_int8_model(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(whisper, "models", {})
+    loaded = []
+
+    def load_model(model_name, device):
+        loaded.append((model_name, device))
+        return benchmark.random_model()
+
+    monkeypatch.setattr(whisper.whisper, "load_model", load_model)
+
+    model = whisper.load_model("tiny-int8")
+    assert loaded == [("tiny", "cpu")]
+    assert isinstance(
+        model.decoder.blocks[0].mlp[0], torch.ao.nn.quantized.dynamic.Linear
+    )
+
+    # the quantized model can transcribe
+    audio = whisper.load_audio(path.join(TEST_DATA, "en.wav"))
+    result = whisper.transcribe_chunks(model, audio, [(0.0, 3.22)], 1, "en")
+    assert result["language"] == "en"
+
+    # and is loaded from the cache after that
+    whisper.models.clear()
+    whisper.load_model("tiny-int8")
+    assert len(loaded) == 1
+
+
+def test_load_audio_preprocessing(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    decoded = []
+    decode_filtered = pcm.decode_filtered
+
+    def counting_decode_filtered(file, filter_chains):
+        decoded.append(len(filter_chains))
+        return decode_filtered(file, filter_chains)
+
+    monkeypatch.setattr(pcm, "decode_filtered", counting_decode_filtered)
+
+    # the first run decodes all the filter chains, the rest find them cached
+    wav = path.join(TEST_DATA, "en.wav")
+    for filters in whisper.preprocessing_combinations:
+        audio = whisper.load_audio(wav, filters)
+        assert numpy.array_equal(audio, pcm.load(wav, filters))
+    assert decoded == [len(whisper.preprocessing_combinations)]
+
+
+def test_whisper_option_combinations_int8():
+    combinations = list(whisper.whisper_option_combinations(8, int8=True))
+    assert len(combinations) == 96
+    assert {options["model_name"] for options in combinations} == {
+        "medium",
+        "medium-int8",
+        "large",
+        "large-int8",
+        "large-v3",
+        "large-v3-int8",
+    }
+    assert all(options["batch_size"] == 8 for options in combinations)
@@ -6,8 +6,10 @@ import os
 import pathlib
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+import boto3.s3.transfer
 import botocore
 import dotenv
 import requests
@@ -17,46 +19,127 @@ from . import utils
 
 dotenv.load_dotenv()
 
-
-def run(output_dir, manifest):
-    results = []
-    for file_metadata in tqdm.tqdm(
-        utils.get_data_files(manifest), desc="aws".ljust(10)
-    ):
-        file_metadata["run_count"] = len(results) + 1
-        file = file_metadata["media_filename"]
-
+# how long to wait for a transcription job before giving up
+JOB_TIMEOUT = 60 * 60 * 4
+
+# media files can be several GB so upload them in parallel parts
+TRANSFER_CONFIG = boto3.s3.transfer.TransferConfig(
+    multipart_threshold=64 * 1024**2,
+    multipart_chunksize=64 * 1024**2,
+    max_concurrency=10,
+)
+
+
+def run(output_dir, manifest, resume=False, concurrency=1):
+    """
+    Transcribe the files in the manifest with AWS Transcribe. If concurrency
+    is more than one, all the files are uploaded and their transcription
+    jobs started up front, using that many threads, and the results are
+    processed as the jobs finish.
+    """
+    results = {}
+    ledger = utils.read_ledger(output_dir) if resume else {}
+    files = []
+    for file_metadata in utils.get_data_files(manifest):
         if file_metadata["media_language"] != file_metadata["transcript_language"]:
-            logging.info("skipping since google doesn't support translation")
+            logging.info("skipping since aws doesn't support translation")
             continue
 
-        logging.info("transcribing with aws %s", file)
+        file_metadata["run_count"] = len(results) + len(files) + 1
+        key = utils.ledger_key(file_metadata["druid"], "aws")
+        if key in ledger:
+            results[file_metadata["run_count"]] = ledger[key]
+        else:
+            files.append(file_metadata)
 
-        start_time = datetime.datetime.now()
-        transcription = transcribe(file_metadata)
-        runtime = utils.get_runtime(start_time)
+    if concurrency > 1:
+        transcriptions = transcribe_concurrently(files, concurrency)
+    else:
+        transcriptions = transcribe_sequentially(files)
 
+    for file_metadata, transcription, metrics in tqdm.tqdm(
+        transcriptions, total=len(files), desc="aws".ljust(10)
+    ):
         result = utils.compare_transcripts(
-            file_metadata, transcription, "aws", output_dir
+            file_metadata, transcription, "aws", output_dir, metrics
         )
 
-        result["runtime"] = runtime
+        result.update(metrics)
 
         with open(os.path.join(output_dir, f"{result['run_id']}.json"), "w") as fh:
             json.dump(transcription, fh, ensure_ascii=False)
 
         logging.info("result: %s", result)
-        results.append(result)
+        key = utils.ledger_key(file_metadata["druid"], "aws")
+        utils.append_ledger(output_dir, key, result)
+        results[file_metadata["run_count"]] = result
+
+    results = [results[run_count] for run_count in sorted(results)]
 
     csv_filename = os.path.join(output_dir, "report-aws.csv")
-    utils.write_report(results, csv_filename)
+    utils.write_report(
+        results,
+        csv_filename,
+        extra_cols=["polls", "poll_wait", "compare_time", "diff_time"],
+    )
+
+
+def transcribe_sequentially(files):
+    for file_metadata in files:
+        logging.info("transcribing with aws %s", file_metadata["media_filename"])
+        metrics = {}
+        start_time = datetime.datetime.now()
+        transcription = transcribe(file_metadata, metrics)
+        metrics["runtime"] = utils.get_runtime(start_time)
+        yield file_metadata, transcription, metrics
+
+
+def transcribe_concurrently(files, concurrency):
+    """
+    Upload the files and start their transcription jobs using a pool of
+    threads, and then yield (file_metadata, transcription, metrics) as the
+    jobs finish, in whatever order that happens.
+    """
+    # create the clients up front since creating them isn't thread safe
+    scribe = get_client("transcribe")
+    get_client("s3")
+
+    start_times = {}
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        for file_metadata in files:
+            logging.info("transcribing with aws %s", file_metadata["media_filename"])
+            start_times[file_metadata["run_count"]] = datetime.datetime.now()
+            futures[pool.submit(start_job, file_metadata)] = file_metadata
+
+        for future in as_completed(futures):
+            jobs[future.result()] = futures[future]
+
+    for job, metrics in wait_for_jobs(scribe, list(jobs)):
+        file_metadata = jobs[job["TranscriptionJob"]["TranscriptionJobName"]]
+        transcription = fetch_transcript(job)
+        metrics["runtime"] = utils.get_runtime(start_times[file_metadata["run_count"]])
+        yield file_metadata, transcription, metrics
+
+
+def transcribe(file_metadata, metrics=None):
+    scribe = get_client("transcribe")
+    job_name = start_job(file_metadata)
+
+    # wait for the job to be complete
+    job = wait_for_job(scribe, job_name, metrics)
 
+    return fetch_transcript(job)
 
-def transcribe(file_metadata):
-    # upload media file to a bucket
+
+def start_job(file_metadata):
+    """
+    Upload the media file to a bucket and start a transcription job for it,
+    returning the name of the job.
+    """
     s3_file = upload_file(file_metadata["media_filename"])
 
-    # create the transcription job
     scribe = get_client("transcribe")
     job_name = str(uuid.uuid1())
     scribe.start_transcription_job(
@@ -65,20 +148,43 @@ def transcribe(file_metadata):
         IdentifyLanguage=True,
     )
 
-    # wait for the job to be complete
-    job = wait_for_job(scribe, job_name)
+    return job_name
 
-    # fetch the results
-    url = job["TranscriptionJob"]["Transcript"]["TranscriptFileUri"]
 
+def fetch_transcript(job):
+    url = job["TranscriptionJob"]["Transcript"]["TranscriptFileUri"]
     return requests.get(url).json()
 
 
 def upload_file(file):
+    """
+    Upload the file to the S3 bucket unless an identical copy is already
+    there, and return its S3 URI. Large files are uploaded in parallel parts.
+    """
     path = pathlib.Path(file)
-    aws_region = os.environ.get("AWS_REGION")
     bucket_name = os.environ.get("AWS_TRANSCRIBE_S3_BUCKET")
 
+    s3 = get_client("s3")
+    create_bucket(bucket_name)
+
+    sha256 = utils.file_hash(path)
+    if is_uploaded(s3, bucket_name, path, sha256):
+        logging.info("skipping upload of %s since it is already in s3", path)
+    else:
+        s3.upload_file(
+            str(path),
+            bucket_name,
+            path.name,
+            ExtraArgs={"Metadata": {"sha256": sha256}},
+            Config=TRANSFER_CONFIG,
+        )
+
+    return f"s3://{bucket_name}/{path.name}"
+
+
+@functools.cache
+def create_bucket(bucket_name):
+    aws_region = os.environ.get("AWS_REGION")
     s3 = get_client("s3")
 
     try:
@@ -94,11 +200,31 @@ def upload_file(file):
         if error.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
             raise error
 
-    s3.upload_file(path, bucket_name, path.name)
 
-    return f"s3://{bucket_name}/{path.name}"
+def is_uploaded(s3, bucket_name, path, sha256):
+    """
+    Check whether the object for the path in the bucket has the same content.
+    Objects uploaded by upload_file carry the sha256 of the file in their
+    metadata, otherwise the ETag can be compared with the MD5 of the file as
+    long as the object wasn't uploaded in parts.
+    """
+    try:
+        head = s3.head_object(Bucket=bucket_name, Key=path.name)
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise error
+
+    if head["ContentLength"] != path.stat().st_size:
+        return False
+    elif head.get("Metadata", {}).get("sha256") == sha256:
+        return True
 
+    etag = head["ETag"].strip('"')
+    return "-" not in etag and etag == utils.file_hash(path, "md5")
 
+
+@functools.cache
 def get_client(service_name):
     return get_session().client(service_name)
 
@@ -118,10 +244,58 @@ def get_session():
     return boto3.session.Session(**config)
 
 
-def wait_for_job(scribe, job_name, wait_seconds=1):
-    time.sleep(wait_seconds)
+def wait_for_job(scribe, job_name, metrics=None):
+    def check():
+        return check_job(scribe, job_name)
+
+    return utils.poll(check, timeout=JOB_TIMEOUT, metrics=metrics)
+
+
+def wait_for_jobs(scribe, job_names):
+    """
+    Poll all the outstanding jobs together, using the same backoff as a
+    single job, and yield (job, metrics) for each job as it completes. Jobs
+    that fail or don't finish within JOB_TIMEOUT are logged and skipped so
+    they don't hold up the rest.
+    """
+    metrics = {job_name: {"polls": 0, "poll_wait": 0.0} for job_name in job_names}
+    outstanding = list(job_names)
+    waited = 0.0
+    for delay in utils.backoff():
+        for job_name in list(outstanding):
+            metrics[job_name]["polls"] += 1
+            metrics[job_name]["poll_wait"] = waited
+            try:
+                job = check_job(scribe, job_name)
+            except RuntimeError as error:
+                logging.error(error)
+                outstanding.remove(job_name)
+                continue
+            if job is not None:
+                outstanding.remove(job_name)
+                yield job, metrics[job_name]
+
+        if len(outstanding) == 0:
+            break
+        elif waited + delay > JOB_TIMEOUT:
+            logging.error("gave up waiting for transcription jobs %s", outstanding)
+            break
+
+        time.sleep(delay)
+        waited += delay
+
+
+def check_job(scribe, job_name):
+    """
+    Return the job if it has completed, None if it is still running, and raise
+    a RuntimeError if it failed.
+    """
     job = scribe.get_transcription_job(TranscriptionJobName=job_name)
-    if job["TranscriptionJob"]["TranscriptionJobStatus"] == "COMPLETED":
+    status = job["TranscriptionJob"]["TranscriptionJobStatus"]
+    if status == "COMPLETED":
         return job
+    elif status == "FAILED":
+        reason = job["TranscriptionJob"].get("FailureReason")
+        raise RuntimeError(f"transcription job {job_name} failed: {reason}")
     else:
-        return wait_for_job(scribe, job_name, wait_seconds**2)
+        return None
@@ -0,0 +1,255 @@
+"""
+Timing the stages of the transcription pipeline on synthetic audio and
+transcripts, so that changes in performance can be compared across commits
+without needing the real media or a large model.
+"""
+
+import datetime
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import wave
+
+import numpy
+import torch
+import whisper as openai_whisper
+from whisper.model import ModelDimensions, Whisper
+
+from . import cache, pcm, utils, whisper
+
+# the stages that can be benchmarked, in the order they are run
+stages = ["decode", "silences", "compare", "transcribe", "transcribe_batched"]
+
+
+def run(
+    duration=120,
+    words=2000,
+    repeats=3,
+    model_name="random",
+    batch_size=8,
+    only=None,
+    seed=0,
+):
+    """
+    Time each of the stages on synthetic audio of the given duration (in
+    seconds) and transcripts of the given number of words, and return a dict
+    of the results which can be saved as JSON. Each stage is run repeats
+    times and the best time is used to compare runs, since it is the least
+    affected by whatever else the machine is doing. The default "random"
+    model is a tiny randomly initialized Whisper, which exercises the same
+    code as a real model without downloading anything.
+    """
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "settings": {
+            "duration": duration,
+            "words": words,
+            "repeats": repeats,
+            "model_name": model_name,
+            "batch_size": batch_size,
+            "seed": seed,
+        },
+        "stages": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_file = os.path.join(tmp_dir, "audio.wav")
+        write_wav(audio_file, synthetic_audio(duration, seed))
+        audio = pcm.decode(audio_file)
+
+        reference, hypothesis = synthetic_transcripts(words, seed=seed)
+        file_metadata = {
+            "druid": "benchmark",
+            "media_filename": audio_file,
+            "transcript_filename": os.path.join(tmp_dir, "reference.txt"),
+            "transcript_language": "en",
+            "run_count": 1,
+        }
+        with open(file_metadata["transcript_filename"], "w") as fh:
+            fh.write("\n".join(reference))
+        transcript = {
+            "language": "en",
+            "segments": [{"text": line} for line in hypothesis],
+        }
+
+        model = None
+        if {"transcribe", "transcribe_batched"} & set(only or stages):
+            model = load_model(model_name)
+
+        stage_functions = {
+            "decode": lambda: pcm.decode(audio_file),
+            "silences": lambda: whisper.find_silences(audio),
+            "compare": lambda: utils.compare_transcripts(
+                file_metadata, transcript, "whisper", tmp_dir
+            ),
+            "transcribe": lambda: openai_whisper.transcribe(
+                model, audio, language="en", temperature=0.0, fp16=False
+            ),
+            "transcribe_batched": lambda: whisper.transcribe_chunks(
+                model,
+                audio,
+                whisper.speech_chunks(whisper.find_silences(audio), duration),
+                batch_size,
+                language="en",
+            ),
+        }
+
+        # keep the cached references out of the real cache
+        cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = os.path.join(tmp_dir, "cache")
+        try:
+            for stage in only or stages:
+                times = time_stage(stage_functions[stage], repeats)
+                results["stages"][stage] = {"best": min(times), "times": times}
+                if stage.startswith("transcribe"):
+                    results["stages"][stage]["rtf"] = min(times) / duration
+        finally:
+            cache.CACHE_DIR = cache_dir
+
+    return results
+
+
+def time_stage(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def compare(results, baseline, max_slowdown=1.25):
+    """
+    Compare the best times of the stages in two sets of results, returning a
+    list of (stage, baseline seconds, seconds, ratio, regressed) for the
+    stages they both have. A stage has regressed if it is more than
+    max_slowdown times slower than the baseline.
+    """
+    rows = []
+    for stage, result in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        before = baseline["stages"][stage]["best"]
+        ratio = result["best"] / before if before > 0 else float("inf")
+        rows.append((stage, before, result["best"], ratio, ratio > max_slowdown))
+    return rows
+
+
+def synthetic_audio(duration, seed=0):
+    """
+    Return duration seconds of 16 kHz audio that looks like speech to the
+    pipeline: phrases of syllable-length harmonic tones, with a varying pitch,
+    separated by pauses, over a little background noise.
+    """
+    rng = numpy.random.default_rng(seed)
+    samples = int(duration * pcm.SAMPLE_RATE)
+    audio = rng.normal(0, 0.002, samples).astype(numpy.float32)
+
+    syllable = int(0.25 * pcm.SAMPLE_RATE)
+    t = numpy.arange(syllable) / pcm.SAMPLE_RATE
+    envelope = numpy.hanning(syllable)
+
+    position = 0
+    while position < samples:
+        phrase_end = position + int(rng.uniform(2, 8) * pcm.SAMPLE_RATE)
+        while position < min(phrase_end, samples):
+            pitch = rng.uniform(100, 250)
+            tone = sum(numpy.sin(2 * numpy.pi * pitch * k * t) / k for k in range(1, 5))
+            block = (0.3 * envelope * tone)[: samples - position]
+            audio[position : position + len(block)] += block
+            position += syllable
+        position += int(rng.uniform(0.3, 1.5) * pcm.SAMPLE_RATE)
+
+    return numpy.clip(audio, -1, 1)
+
+
+def synthetic_transcripts(words, error_rate=0.1, line_length=12, seed=0):
+    """
+    Return reference and hypothesis transcripts, as lists of lines, with the
+    given number of words. The hypothesis has roughly error_rate of the words
+    substituted, deleted or with a word inserted after them.
+    """
+    rng = numpy.random.default_rng(seed)
+    syllables = ["ka", "lo", "mi", "ne", "ra", "su", "ti", "vo", "de", "ba"]
+    vocabulary = [
+        "".join(rng.choice(syllables, size=rng.integers(1, 4))) for _ in range(500)
+    ]
+
+    reference = list(rng.choice(vocabulary, size=words))
+    hypothesis = []
+    for word in reference:
+        error = rng.random()
+        if error < error_rate / 3:
+            hypothesis.append(str(rng.choice(vocabulary)))
+        elif error < error_rate * 2 / 3:
+            continue
+        elif error < error_rate:
+            hypothesis.extend([word, str(rng.choice(vocabulary))])
+        else:
+            hypothesis.append(word)
+
+    return lines(reference, line_length), lines(hypothesis, line_length)
+
+
+def lines(words, line_length):
+    return [
+        " ".join(words[i : i + line_length]).capitalize() + "."
+        for i in range(0, len(words), line_length)
+    ]
+
+
+def write_wav(path, audio):
+    with wave.open(path, "wb") as fh:
+        fh.setnchannels(1)
+        fh.setsampwidth(2)
+        fh.setframerate(pcm.SAMPLE_RATE)
+        fh.writeframes((audio * 32767).astype("<i2").tobytes())
+
+
+def load_model(model_name):
+    if model_name == "random":
+        return random_model()
+    return whisper.load_model(model_name)
+
+
+def random_model():
+    """
+    A randomly initialized multilingual Whisper model with a single small
+    layer, which is quick to run on a CPU.
+    """
+    torch.manual_seed(0)
+    dims = ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=64,
+        n_audio_head=1,
+        n_audio_layer=1,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=64,
+        n_text_head=1,
+        n_text_layer=1,
+    )
+    model = Whisper(dims)
+    # this is left uninitialized for the checkpoint to fill in
+    torch.nn.init.normal_(model.decoder.positional_embedding, std=0.01)
+    return model
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,205 @@
+"""
+A small on-disk cache of NumPy arrays, which are stored as .npy files and
+loaded memory-mapped so that several processes can share them without each
+holding a copy in memory. Smaller JSON serializable data can be cached too.
+Each store is a subdirectory of the cache directory, and together they are
+kept under a maximum size by removing the least recently used files.
+
+The location and size of the cache can be configured with the
+WHISPER_PILOT_CACHE and WHISPER_PILOT_CACHE_SIZE (in bytes) environment
+variables.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+import dotenv
+import numpy
+
+dotenv.load_dotenv()
+
+CACHE_DIR = os.environ.get(
+    "WHISPER_PILOT_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "whisper-pilot"),
+)
+
+MAX_BYTES = int(os.environ.get("WHISPER_PILOT_CACHE_SIZE", 50 * 1024**3))
+
+
+def get_dir(store):
+    path = os.path.join(CACHE_DIR, store)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def make_key(*parts):
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def lock(key):
+    """
+    Hold an exclusive lock for the key across processes, so that those about
+    to compute the same cache entry can wait for the first of them and then
+    load its result from the cache. Keys share 256 lock files by their first
+    two characters, so the number of lock files stays fixed.
+    """
+    path = os.path.join(get_dir("locks"), f"{key[:2]}.lock")
+    with open(path, "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def get_path(store, key):
+    return os.path.join(get_dir(store), f"{key}.npy")
+
+
+def load(store, key):
+    """
+    Returns the cached array or None if it isn't in the cache. The array is
+    mapped copy-on-write so it can be modified without changing the cache.
+    """
+    path = get_path(store, key)
+    try:
+        array = numpy.load(path, mmap_mode="c")
+    except FileNotFoundError:
+        return None
+
+    # bump the modification time since it is used for LRU eviction
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # another process pruned it, but the mapping is still usable
+        pass
+
+    return array
+
+
+def save(store, key, array, max_bytes=None):
+    """
+    Write the array to the cache, and return the memory-mapped copy.
+    """
+    path = get_path(store, key)
+
+    # write to a temporary file first so that other processes never see a
+    # partially written array
+    fd, tmp_path = tempfile.mkstemp(dir=get_dir(store), suffix=".tmp")
+    with os.fdopen(fd, "wb") as fh:
+        numpy.save(fh, array)
+
+    # the array is mapped before it is in the cache, so that it is returned
+    # even if pruning removes it, e.g. when it is too big for the cache
+    array = numpy.load(tmp_path, mmap_mode="c")
+    os.replace(tmp_path, path)
+    prune(max_bytes)
+
+    return array
+
+
+def save_blocks(store, key, blocks, dtype=numpy.float32, max_bytes=None):
+    """
+    Write a one dimensional array, given as an iterable of blocks, to the cache
+    without holding all of it in memory, and return the memory-mapped copy.
+    """
+    # the length isn't known until the end, so the blocks are written to a
+    # raw file first and then copied into the .npy file
+    fd, raw_path = tempfile.mkstemp(dir=get_dir(store), suffix=".tmp")
+    length = 0
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            for block in blocks:
+                fh.write(numpy.asarray(block, dtype=dtype).tobytes())
+                length += len(block)
+
+        fd, tmp_path = tempfile.mkstemp(dir=get_dir(store), suffix=".tmp")
+        os.close(fd)
+        if length == 0:
+            numpy.save(tmp_path, numpy.empty(0, dtype=dtype))
+            os.replace(f"{tmp_path}.npy", tmp_path)
+        else:
+            raw = numpy.memmap(raw_path, dtype=dtype, mode="r", shape=(length,))
+            array = numpy.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=dtype, shape=(length,)
+            )
+            step = 1024 * 1024
+            for i in range(0, length, step):
+                array[i : i + step] = raw[i : i + step]
+            array.flush()
+            del array, raw
+        array = numpy.load(tmp_path, mmap_mode="c")
+        os.replace(tmp_path, get_path(store, key))
+    finally:
+        os.remove(raw_path)
+
+    prune(max_bytes)
+
+    return array
+
+
+def load_json(store, key):
+    """
+    Returns the cached JSON data or None if it isn't in the cache.
+    """
+    path = os.path.join(get_dir(store), f"{key}.json")
+    try:
+        with open(path) as fh:
+            data = json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    # bump the modification time since it is used for LRU eviction
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # another process pruned it after it was read
+        pass
+
+    return data
+
+
+def save_json(store, key, data, max_bytes=None):
+    fd, tmp_path = tempfile.mkstemp(dir=get_dir(store), suffix=".tmp")
+    with os.fdopen(fd, "w") as fh:
+        json.dump(data, fh, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(get_dir(store), f"{key}.json"))
+
+    prune(max_bytes)
+
+
+def prune(max_bytes=None):
+    """
+    Remove the least recently used arrays and JSON files, from any of the
+    stores, until the cache fits in max_bytes.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+
+    entries = []
+    for store in os.scandir(CACHE_DIR):
+        if not store.is_dir():
+            continue
+        for entry in os.scandir(store.path):
+            if entry.name.endswith((".npy", ".json")):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # another process pruned it
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another process got there first
+            pass
+        total -= size
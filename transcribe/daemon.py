@@ -0,0 +1,102 @@
+"""
+A long running process that keeps whisper models loaded, so that short
+transcription jobs don't spend most of their time starting up. The daemon
+listens on a Unix socket, and whisper.transcribe sends its work there when the
+WHISPER_PILOT_DAEMON environment variable is set to the socket's path.
+
+Requests and responses are single lines of JSON.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from . import whisper
+
+
+def serve(socket_path, preload=(), max_models=3):
+    """
+    Load the preload models and handle transcription requests on the socket
+    until the process is stopped. Up to max_models models are kept in memory.
+    """
+    whisper.MAX_MODELS = max(max_models, len(preload))
+    for model_name in preload:
+        logging.info("loading %s", model_name)
+        whisper.load_model(model_name)
+
+    with make_server(socket_path) as server:
+        logging.info("listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def make_server(socket_path):
+    # a socket left behind by a daemon that was killed would be in the way
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    os.chmod(socket_path, 0o600)
+    return server
+
+
+# torch already uses all the cores, so requests are transcribed one at a time
+lock = threading.Lock()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            message = json.loads(line)
+            file_metadata, options = message["file_metadata"], message["options"]
+            logging.info("transcribing %s", file_metadata["media_filename"])
+            try:
+                metrics = {}
+                with lock:
+                    transcription = whisper.transcribe(
+                        file_metadata, options, metrics, use_daemon=False
+                    )
+                response = {"transcription": transcription, "metrics": metrics}
+            except Exception as e:
+                logging.exception("transcription failed")
+                response = {"error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode())
+            self.wfile.write(b"\n")
+            self.wfile.flush()
+
+
+def request(socket_path, file_metadata, options, metrics=None):
+    """
+    Have the daemon listening on the socket transcribe the file with the
+    options, and return the transcription. If a metrics dict is supplied the
+    metrics from the daemon are added to it.
+    """
+    # the daemon may have been started in a different directory
+    media_filename = os.path.abspath(file_metadata["media_filename"])
+    message = {
+        "file_metadata": {**file_metadata, "media_filename": media_filename},
+        "options": options,
+    }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as fh:
+            fh.write(json.dumps(message, ensure_ascii=False).encode())
+            fh.write(b"\n")
+            fh.flush()
+            line = fh.readline()
+
+    if not line:
+        raise RuntimeError(f"whisper daemon at {socket_path} closed the connection")
+    response = json.loads(line)
+    if "error" in response:
+        raise RuntimeError(f"whisper daemon failed: {response['error']}")
+
+    if metrics is not None:
+        metrics.update(response["metrics"])
+    return response["transcription"]
@@ -1,7 +1,10 @@
+import contextlib
 import datetime
+import functools
 import json
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
 
@@ -12,9 +15,16 @@ from google.protobuf.json_format import MessageToDict
 
 from . import utils
 
+# flac is streamed to google storage in parts of this size
+UPLOAD_CHUNK_SIZE = 32 * 1024**2
 
-def run(output_dir, manifest):
+# audio is sent to google as mono flac at this sample rate
+FLAC_SAMPLE_RATE = 16000
+
+
+def run(output_dir, manifest, resume=False):
     results = []
+    ledger = utils.read_ledger(output_dir) if resume else {}
     for file_metadata in tqdm.tqdm(
         utils.get_data_files(manifest), desc="google".ljust(10)
     ):
@@ -25,38 +35,49 @@ def run(output_dir, manifest):
             logging.info("skipping since google doesn't support translation")
             continue
 
+        key = utils.ledger_key(file_metadata["druid"], "google")
+        if key in ledger:
+            results.append(ledger[key])
+            continue
+
         logging.info(f"running google speech-to-text with {file}")
 
+        metrics = {}
         start_time = datetime.datetime.now()
-        transcription = transcribe(file_metadata)
-        runtime = utils.get_runtime(start_time)
+        transcription = transcribe(file_metadata, metrics)
+        metrics["runtime"] = utils.get_runtime(start_time)
 
         result = utils.compare_transcripts(
-            file_metadata, transcription, "google", output_dir
+            file_metadata, transcription, "google", output_dir, metrics
         )
-        result["runtime"] = runtime
+        result.update(metrics)
 
         with open(os.path.join(output_dir, f"{result['run_id']}.json"), "w") as fh:
             json.dump(transcription, fh, ensure_ascii=False)
 
         logging.info(f"result: {result}")
+        utils.append_ledger(output_dir, key, result)
         results.append(result)
 
     csv_filename = os.path.join(output_dir, "report-google.csv")
-    utils.write_report(results, csv_filename)
+    utils.write_report(
+        results,
+        csv_filename,
+        extra_cols=["polls", "poll_wait", "compare_time", "diff_time"],
+    )
 
 
-def transcribe(file_metadata):
+def transcribe(file_metadata, metrics=None):
     """
     Sends the media file using Google Speech API, and returns the result as a dict.
+    If a metrics dict is supplied the polling statistics are added to it.
     """
 
-    # convert the media file to single channel wav and upload to google cloud
-    wav_file = convert_to_wav(file_metadata["media_filename"])
-    blob_uri = copy_file(wav_file)
+    # convert the media file to 16 kHz mono flac in google cloud storage
+    blob_uri = copy_flac(file_metadata["media_filename"])
     audio = speech.RecognitionAudio(uri=blob_uri)
 
-    logging.info(f"starting speech-to-text job for {wav_file}")
+    logging.info(f"starting speech-to-text job for {blob_uri}")
 
     # unlike aws and whisper, google v1 speech API needs to know the language
     # v2 appears to be different but I couldn't get it to work properly
@@ -64,44 +85,102 @@ def transcribe(file_metadata):
     # decide to use Google
 
     language = file_metadata["media_language"]
-    config = speech.RecognitionConfig(language_code=language)
+    config = speech.RecognitionConfig(
+        language_code=language,
+        encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
+        sample_rate_hertz=FLAC_SAMPLE_RATE,
+        audio_channel_count=1,
+    )
 
     # send the transcription job to google
     client = speech.SpeechClient()
     operation = client.long_running_recognize(audio=audio, config=config)
-    response = operation.result(timeout=60 * 60 * 2)
-
-    # remove the temporary wav file
-    os.remove(wav_file)
+    response = utils.poll(
+        lambda: wait_for_operation(operation), timeout=60 * 60 * 2, metrics=metrics
+    )
 
     return MessageToDict(response._pb)
 
 
-def copy_file(media_file):
-    bucket_name = os.environ.get("GOOGLE_TRANSCRIBE_GCS_BUCKET")
-    logging.info(f"copying {media_file} to google storage bucket {bucket_name}")
-    storage_client = storage.Client()
+def wait_for_operation(operation):
+    """
+    Return the result of the operation if it is done, or None if it's still
+    running. If the operation failed result() raises its error.
+    """
+    if operation.done():
+        return operation.result()
+    return None
 
+
+@functools.cache
+def get_bucket(bucket_name):
+    storage_client = storage.Client()
     try:
-        bucket = storage_client.get_bucket(bucket_name)
+        return storage_client.get_bucket(bucket_name)
     except NotFound:
-        bucket = storage_client.create_bucket(bucket_name)
+        return storage_client.create_bucket(bucket_name)
+
+
+def copy_flac(media_file):
+    """
+    Convert the media file to 16 kHz mono FLAC and stream it straight into the
+    Google Cloud Storage bucket, returning its gs:// URI. The FLAC is named
+    after the content hash of the media file so later runs reuse it without
+    converting or uploading anything.
+    """
+    bucket_name = os.environ.get("GOOGLE_TRANSCRIBE_GCS_BUCKET")
+    bucket = get_bucket(bucket_name)
+    filename = f"{utils.file_hash(media_file)}.flac"
+
+    if bucket.get_blob(filename) is not None:
+        logging.info(f"using existing flac for {media_file} in {bucket_name}")
+        return f"gs://{bucket_name}/{filename}"
 
-    filename = os.path.basename(media_file)
+    logging.info(f"streaming {media_file} as flac to {bucket_name}/{filename}")
     blob = bucket.blob(filename)
-    blob.upload_from_filename(media_file)
+    # ffmpeg's exit status is checked before the upload is closed, so that if
+    # it fails the upload is abandoned rather than committing a truncated flac
+    with blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type="audio/flac") as fh:
+        with convert_to_flac(media_file) as flac:
+            shutil.copyfileobj(flac, fh, UPLOAD_CHUNK_SIZE)
 
     return f"gs://{bucket_name}/{filename}"
 
 
-def convert_to_wav(media_file):
-    temp_dir = tempfile.gettempdir()
-    wav_file = os.path.join(temp_dir, os.path.basename(media_file))
-    wav_file, ext = os.path.splitext(wav_file)
-    wav_file = f"{wav_file}.wav"
-
-    logging.info(f"ffmpeg converting {media_file} to {wav_file}")
-    subprocess.run(
-        ["ffmpeg", "-y", "-loglevel", "panic", "-i", media_file, "-ac", "1", wav_file]
+@contextlib.contextmanager
+def convert_to_flac(media_file):
+    """
+    Yield a stream of the media file converted to mono FLAC at 16 kHz by
+    ffmpeg, without writing it to disk.
+    """
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-i",
+            media_file,
+            "-ac",
+            "1",
+            "-ar",
+            str(FLAC_SAMPLE_RATE),
+            "-f",
+            "flac",
+            "pipe:1",
+        ],
+        stdout=subprocess.PIPE,
+        # a pipe could fill up and block ffmpeg while the flac is being read
+        stderr=stderr,
     )
-    return wav_file
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        with stderr:
+            stderr.seek(0)
+            errors = stderr.read()
+        if returncode != 0:
+            raise RuntimeError(f"Failed to convert {media_file}: {errors.decode()}")
@@ -0,0 +1,260 @@
+"""
+Decoding media files into the 16 kHz mono float32 PCM that Whisper expects.
+"""
+
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from . import cache, utils
+
+SAMPLE_RATE = 16000
+
+# audio is streamed from ffmpeg in blocks of this many samples
+BLOCK_SIZE = SAMPLE_RATE * 30
+
+# silences are returned as arrays of (start, end, duration) in seconds
+SILENCE = numpy.dtype([("start", "f8"), ("end", "f8"), ("duration", "f8")])
+
+
+def load(file, filters=None):
+    """
+    Return the decoded audio for a media file, optionally passed through an
+    ffmpeg filter chain (e.g. "highpass=200,lowpass=3000"). The decoded audio
+    is cached on disk using the content of the file and the filter chain, so
+    the same media is only decoded once regardless of its filename or how
+    often it is used, even by processes that want it at the same time. The
+    audio is streamed into the cache and returned memory-mapped, so long files
+    don't need to fit in memory.
+    """
+    key = cache.make_key(utils.file_hash(file), filters or "")
+    audio = cache.load("audio", key)
+    if audio is None:
+        # wait for any other process decoding it and then check again
+        with cache.lock(key):
+            audio = cache.load("audio", key)
+            if audio is None:
+                audio = cache.save_blocks("audio", key, stream(file, filters))
+
+    return audio
+
+
+def load_filtered(file, filter_chains):
+    """
+    Return the decoded audio for the file passed through each of the ffmpeg
+    filter chains. Any that aren't already cached are decoded together with a
+    single ffmpeg invocation, so the file only needs to be read once. Other
+    processes wanting the same file at the same time wait for the decoding to
+    finish and then find it in the cache.
+    """
+    file_hash = utils.file_hash(file)
+    keys = [cache.make_key(file_hash, filters) for filters in filter_chains]
+    results = [cache.load("audio", key) for key in keys]
+    if all(audio is not None for audio in results):
+        return results
+
+    with cache.lock(cache.make_key(file_hash)):
+        results = [cache.load("audio", key) for key in keys]
+        missing = [i for i, audio in enumerate(results) if audio is None]
+        if missing:
+            outputs = decode_filtered(file, [filter_chains[i] for i in missing])
+            with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+                futures = [
+                    pool.submit(cache.save_blocks, "audio", keys[i], blocks)
+                    for i, blocks in zip(missing, outputs)
+                ]
+                for i, future in zip(missing, futures):
+                    results[i] = future.result()
+
+    return results
+
+
+def decode_filtered(file, filter_chains, block_size=BLOCK_SIZE):
+    """
+    Decode the file once, splitting the audio to run it through each of the
+    ffmpeg filter chains. Each filter chain has its own output, which ffmpeg
+    writes as raw PCM to a separate pipe. A generator of blocks is returned
+    for each output, in the same order as the filter chains. They need to be
+    consumed at the same time (e.g. in threads) so that ffmpeg never blocks
+    writing to a full pipe.
+    """
+    splits = "".join(f"[s{i}]" for i in range(len(filter_chains)))
+    graph = [f"[0:a]asplit={len(filter_chains)}{splits}"]
+    graph.extend(f"[s{i}]{filters}[o{i}]" for i, filters in enumerate(filter_chains))
+
+    pipes = [os.pipe() for _ in filter_chains]
+    cmd = ffmpeg_command(file)
+    cmd.extend(["-filter_complex", ";".join(graph)])
+    for i, (_, write_fd) in enumerate(pipes):
+        cmd.extend(["-map", f"[o{i}]", *output_options, f"pipe:{write_fd}"])
+
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.DEVNULL,
+        stderr=stderr,
+        pass_fds=[write_fd for _, write_fd in pipes],
+    )
+    for _, write_fd in pipes:
+        os.close(write_fd)
+
+    # every output waits to see how ffmpeg exited before it ends, so that
+    # none of them are cached if it failed or was killed partway through
+    errors = []
+    lock = threading.Lock()
+
+    def check():
+        with lock:
+            if not errors:
+                try:
+                    check_process(process, stderr)
+                    errors.append(None)
+                except RuntimeError as error:
+                    errors.append(error)
+        if errors[0] is not None:
+            raise errors[0]
+
+    def blocks(read_fd):
+        with os.fdopen(read_fd, "rb") as fh:
+            yield from read_blocks(fh, block_size)
+        check()
+
+    return [blocks(read_fd) for read_fd, _ in pipes]
+
+
+def stream(file, filters=None, block_size=BLOCK_SIZE):
+    """
+    Yield the decoded audio for the file in blocks of block_size samples (the
+    last one may be shorter), so that audio can be processed without holding
+    all of it in memory.
+    """
+    cmd = ffmpeg_command(file)
+    if filters:
+        cmd.extend(["-af", filters])
+    cmd.extend([*output_options, "-"])
+
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+    finished = False
+    try:
+        yield from read_blocks(process.stdout, block_size)
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished:
+            # the consumer stopped early
+            process.kill()
+            process.wait()
+            stderr.close()
+
+    check_process(process, stderr)
+
+
+def decode(file, filters=None):
+    """
+    Decode the media file with ffmpeg into a single array. This is the same as
+    whisper.load_audio but with an optional ffmpeg filter chain.
+    """
+    return numpy.concatenate([numpy.empty(0, numpy.float32), *stream(file, filters)])
+
+
+def ffmpeg_command(file):
+    return ["ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0", "-i", file]
+
+
+# the options for ffmpeg to write 16 kHz mono PCM
+output_options = [
+    "-f",
+    "s16le",
+    "-ac",
+    "1",
+    "-acodec",
+    "pcm_s16le",
+    "-ar",
+    str(SAMPLE_RATE),
+]
+
+
+def read_blocks(fh, block_size):
+    while True:
+        data = fh.read(block_size * 2)
+        if not data:
+            break
+        yield numpy.frombuffer(data, numpy.int16).astype(numpy.float32) / 32768.0
+
+
+def check_process(process, stderr):
+    """
+    Wait for ffmpeg to exit and raise an error with what it wrote to stderr if
+    it failed. Its stderr goes to a temporary file rather than a pipe, since
+    ffmpeg would block if it filled the pipe while its output is being read.
+    """
+    returncode = process.wait()
+    with stderr:
+        stderr.seek(0)
+        errors = stderr.read()
+    if returncode != 0:
+        raise RuntimeError(f"Failed to load audio: {errors.decode()}")
+
+
+def mean_volume(audio, block_size=SAMPLE_RATE * 60):
+    """
+    Return the mean volume of the audio in dB, like ffmpeg's volumedetect. The
+    sum of squares is accumulated in blocks to avoid a float64 copy of all the
+    audio.
+    """
+    total = 0.0
+    for i in range(0, len(audio), block_size):
+        block = numpy.asarray(audio[i : i + block_size], dtype=numpy.float64)
+        total += numpy.dot(block, block)
+    if total == 0:
+        return -numpy.inf
+    return 10 * numpy.log10(total / len(audio))
+
+
+def detect_silences(audio, noise, min_duration=0.5, block_size=BLOCK_SIZE):
+    """
+    Return an array of SILENCE intervals where the audio stays below the noise
+    level (in dB) for at least min_duration seconds, like ffmpeg's
+    silencedetect. A silence that runs to the end of the audio ends there. The
+    audio is examined in blocks so memory use doesn't grow with its length.
+    """
+    threshold = 10 ** (noise / 20)
+    min_samples = min_duration * SAMPLE_RATE
+
+    silences = []
+    open_start = None
+    for offset in range(0, len(audio), block_size):
+        quiet = numpy.abs(audio[offset : offset + block_size]) < threshold
+
+        # find where runs of quiet samples start and end in this block
+        edges = numpy.diff(quiet.astype(numpy.int8), prepend=open_start is not None)
+        starts = (numpy.flatnonzero(edges == 1) + offset).tolist()
+        ends = (numpy.flatnonzero(edges == -1) + offset).tolist()
+
+        # a run may have started in a previous block
+        if open_start is not None:
+            starts.insert(0, open_start)
+        open_start = starts.pop() if len(starts) > len(ends) else None
+
+        silences.extend(
+            (start, end)
+            for start, end in zip(starts, ends)
+            if end - start >= min_samples
+        )
+
+    if open_start is not None and len(audio) - open_start >= min_samples:
+        silences.append((open_start, len(audio)))
+
+    result = numpy.empty(len(silences), dtype=SILENCE)
+    if len(silences) > 0:
+        samples = numpy.array(silences)
+        result["start"] = samples[:, 0] / SAMPLE_RATE
+        result["end"] = samples[:, 1] / SAMPLE_RATE
+        result["duration"] = result["end"] - result["start"]
+
+    return result
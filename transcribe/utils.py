@@ -1,15 +1,26 @@
+import contextlib
 import csv
 import datetime
-import difflib
+import functools
+import hashlib
+import html
+import inspect
+import json
 import os
+import random
 import re
+import resource
 import string
 import textwrap
+import threading
+import time
 from collections import Counter
-from io import StringIO
 
-import jiwer
+import numpy
 import webvtt
+from rapidfuzz.distance import Levenshtein
+
+from . import cache
 
 base_csv_columns = [
     "run_id",
@@ -30,6 +41,23 @@ base_csv_columns = [
     "diff",
 ]
 
+# per-stage timings (seconds) and resource usage recorded for each run
+profile_csv_columns = [
+    "audio_duration",
+    "rtf",
+    "load_model_time",
+    "decode_time",
+    "inference_time",
+    "compare_time",
+    "diff_time",
+    "write_time",
+    "peak_rss_mb",
+    "rss_mb",
+    "pss_mb",
+    "worker_pid",
+    "torch_threads",
+]
+
 
 def get_data_files(manifest):
     rows = []
@@ -38,11 +66,94 @@ def get_data_files(manifest):
     return rows
 
 
+def get_durations(path):
+    """
+    Return the durations of the media in seconds keyed by druid, from a
+    spreadsheet like sdr-data.csv with Druid and Duration (H:MM:SS) columns.
+    Rows without a usable duration are left out.
+    """
+    durations = {}
+    with open(path) as fh:
+        for row in csv.DictReader(fh):
+            try:
+                parts = [float(part) for part in row["Duration"].split(":")]
+            except (KeyError, AttributeError, ValueError):
+                continue
+            seconds = 0.0
+            for part in parts:
+                seconds = seconds * 60 + part
+            durations[row["Druid"]] = seconds
+    return durations
+
+
 def get_runtime(start_time):
     elapsed = datetime.datetime.now() - start_time
     return elapsed.total_seconds()
 
 
+@contextlib.contextmanager
+def timed(metrics, stage):
+    """
+    Add the seconds spent in the with block to metrics[f"{stage}_time"]. If
+    metrics is None nothing is recorded.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            key = f"{stage}_time"
+            metrics[key] = metrics.get(key, 0) + time.perf_counter() - start
+
+
+def peak_rss():
+    """
+    Return the peak resident memory of this process so far in MB.
+    """
+    # linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memory_usage():
+    """
+    Return the current resident (rss_mb) and proportional (pss_mb) memory of
+    this process in MB. Memory shared with other processes, like model weights
+    shared by workers, only counts towards the PSS in proportion to the number
+    of processes sharing it, so summing the PSS of the workers gives their
+    total memory use. This is only available on Linux, otherwise an empty dict
+    is returned.
+    """
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as fh:
+            for line in fh:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    usage[f"{name.lower()}_mb"] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return usage
+
+
+def file_hash(path, algorithm="sha256"):
+    """
+    Return a hex digest of the content of a file. Since media files can be
+    large the digest is remembered for as long as the file's size and
+    modification time don't change.
+    """
+    stat = os.stat(path)
+    return _file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, algorithm)
+
+
+@functools.lru_cache(maxsize=1024)
+def _file_hash(path, size, mtime, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def write_report(rows, csv_path, extra_cols=[]):
     fieldnames = base_csv_columns.copy()
     if len(extra_cols) > 0:
@@ -54,33 +165,127 @@ def write_report(rows, csv_path, extra_cols=[]):
             writer.writerow(row)
 
 
-def compare_transcripts(file, transcript, transcript_type, output_dir):
+def backoff(initial=1, factor=2, cap=60, jitter=0.1):
+    """
+    Yield an endless series of delays in seconds that grow exponentially from
+    initial up to cap. Each delay is randomly adjusted by up to the jitter
+    fraction so that lots of pollers don't end up in lockstep.
+    """
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, cap)
+
+
+def poll(check, timeout=None, metrics=None, **backoff_options):
+    """
+    Call check until it returns something other than None and return that.
+    The calls are spaced out using backoff, which can be adjusted with
+    backoff_options. check should raise an exception if whatever it is
+    checking on has failed. A TimeoutError is raised if the result isn't
+    available after timeout seconds.
+
+    If a metrics dictionary is supplied the number of polls and the number of
+    seconds spent waiting are added to it as "polls" and "poll_wait".
+    """
+    polls = 0
+    waited = 0.0
+    try:
+        for delay in backoff(**backoff_options):
+            polls += 1
+            result = check()
+            if result is not None:
+                return result
+            if timeout is not None and waited + delay > timeout:
+                raise TimeoutError(f"gave up polling after {waited:.0f} seconds")
+            time.sleep(delay)
+            waited += delay
+    finally:
+        if metrics is not None:
+            metrics["polls"] = metrics.get("polls", 0) + polls
+            metrics["poll_wait"] = metrics.get("poll_wait", 0) + waited
+
+
+def ledger_key(druid, engine, options=None):
+    """
+    Return the key used to identify a run in the ledger.
+    """
+    return json.dumps([druid, engine, options], sort_keys=True)
+
+
+def read_ledger(output_dir):
+    """
+    Read the results of finished runs from the ledger in the output_dir, and
+    return them as a dictionary keyed by their ledger_key.
+    """
+    results = {}
+    path = os.path.join(output_dir, "ledger.jsonl")
+    if not os.path.isfile(path):
+        return results
+
+    with open(path) as fh:
+        for line in fh:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be incomplete if the run was killed
+                continue
+            results[entry["key"]] = entry["result"]
+
+    return results
+
+
+def append_ledger(output_dir, key, result):
+    """
+    Record the result of a finished run in the ledger in the output_dir. The
+    ledger is only ever appended to so that results aren't lost if a sweep
+    is interrupted.
+    """
+    path = os.path.join(output_dir, "ledger.jsonl")
+    with open(path, "a") as fh:
+        fh.write(json.dumps({"key": key, "result": result}, ensure_ascii=False))
+        fh.write("\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def compare_transcripts(file, transcript, transcript_type, output_dir, metrics=None):
     """
     Compare the given file (a dictionary of file metadata, a row from data.csv).
     To the given transcript result, and the transcript_type in order to
     differentiate the different ways that results are represented. The
     output_dir is supplied because in addition to returning the comparison an
-    HTML diff will be written to the output_dir.
+    HTML diff will be written to the output_dir. If a metrics dict is supplied
+    the time spent comparing and writing the diff is added to it.
     """
     run_id = f"{file['druid']}-{transcript_type}-{file['run_count']:03}"
 
-    if transcript_type == "google":
-        hypothesis, lang = parse_google(transcript)
-    elif transcript_type == "aws":
-        hypothesis, lang = parse_aws(transcript)
-    elif transcript_type == "whisper":
-        hypothesis, lang = parse_whisper(transcript)
-    else:
-        raise Exception("Unknown transcript type: {transcript_type}")
+    with timed(metrics, "compare"):
+        if transcript_type == "google":
+            hypothesis, lang = parse_google(transcript)
+        elif transcript_type == "aws":
+            hypothesis, lang = parse_aws(transcript)
+        elif transcript_type == "whisper":
+            hypothesis, lang = parse_whisper(transcript)
+        else:
+            raise Exception("Unknown transcript type: {transcript_type}")
 
-    reference = read_reference_file(file["transcript_filename"])
+        reference = load_reference(file["transcript_filename"])
+        hypothesis_ids = token_ids(clean_text(hypothesis))
 
-    stats = jiwer.process_words(clean_text(reference), clean_text(hypothesis))
+        stats = word_stats(reference["ids"], hypothesis_ids)
 
     diff_file = f"{run_id}.html"
     diff_url = f"https://sul-dlss.github.io/whisper-pilot/{os.path.basename(output_dir)}/{diff_file}"
     diff_path = os.path.join(output_dir, diff_file)
-    write_diff(file["druid"], reference, hypothesis, diff_path)
+    with timed(metrics, "diff"):
+        write_diff(
+            file["druid"],
+            reference["lines"],
+            hypothesis,
+            diff_path,
+            reference_sentences=reference["sentences"],
+        )
 
     return {
         "run_id": run_id,
@@ -88,19 +293,141 @@ def compare_transcripts(file, transcript, transcript_type, output_dir):
         "file": os.path.basename(file["media_filename"]),
         "transcript_filename": os.path.basename(file["transcript_filename"]),
         "transcript_language": file["transcript_language"],
-        "wer": stats.wer,
-        "mer": stats.mer,
-        "wil": stats.wil,
-        "wip": stats.wip,
-        "hits": stats.hits,
-        "substitutions": stats.substitutions,
-        "insertions": stats.insertions,
-        "deletions": stats.deletions,
+        **stats,
         "language": lang,
         "diff": diff_url,
     }
 
 
+def load_reference(path):
+    """
+    Read a reference transcript and return a dictionary with its "lines", the
+    "words" of its normalized text, the "ids" of those words and its
+    "sentences" for diffing. Since the same reference is compared with every
+    run for a file the result is kept in memory, and it is also cached on disk
+    for other processes (rerun_diffs, notebooks). The cache is keyed by the
+    content of the file and the code used to normalize it.
+    """
+    return _load_reference(path, file_hash(path))
+
+
+@functools.lru_cache(maxsize=32)
+def _load_reference(path, sha256):
+    key = cache.make_key(sha256, normalization_version())
+    reference = cache.load_json("references", key)
+    if reference is None:
+        lines = read_reference_file(path)
+        reference = {
+            "lines": lines,
+            "words": clean_text(lines).split(),
+            "sentences": split_sentences(strip_rev_formatting(lines)),
+        }
+        cache.save_json("references", key, reference)
+
+    reference["ids"] = word_ids(reference["words"])
+    return reference
+
+
+@functools.cache
+def comparison_version():
+    """
+    Return a hash of the code used to compare transcripts and write diffs, so
+    that comparisons can be rerun when it changes.
+    """
+    functions = [compare_transcripts, word_stats, write_diff, diff_rows, diff_words]
+    source = "".join(inspect.getsource(function) for function in functions)
+    source += normalization_version() + diff_template
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+@functools.cache
+def normalization_version():
+    """
+    Return a hash of the code used to read and normalize transcripts, so
+    cached results can be discarded when it changes.
+    """
+    functions = [read_reference_file, clean_text, strip_rev_formatting, split_sentences]
+    source = "".join(inspect.getsource(function) for function in functions)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+# every distinct word that has been seen is assigned an integer id
+vocabulary = {}
+vocabulary_lock = threading.Lock()
+
+
+def token_ids(text):
+    """
+    Return an array of integer ids for the space separated words in the text.
+    """
+    return word_ids(text.split())
+
+
+def word_ids(words):
+    """
+    Return an array of integer ids for the words, which are the same for the
+    same word in any transcript.
+    """
+    # transcripts can be compared in threads, which mustn't give two words the
+    # same id
+    with vocabulary_lock:
+        return intern(words, vocabulary)
+
+
+def intern(items, table):
+    """
+    Return an array of integer ids for the items, adding any that are new to
+    the table of ids.
+    """
+    return numpy.fromiter(
+        (table.setdefault(item, len(table)) for item in items),
+        dtype=numpy.int64,
+        count=len(items),
+    )
+
+
+def word_stats(reference_ids, hypothesis_ids):
+    """
+    Align the reference and hypothesis token ids and return the same measures
+    as jiwer.process_words. The alignment is done by rapidfuzz, which uses
+    Hirschberg's algorithm for long sequences so memory use stays linear.
+    """
+    hits = substitutions = deletions = insertions = 0
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(reference_ids, hypothesis_ids):
+        if tag == "equal":
+            hits += i2 - i1
+        elif tag == "replace":
+            substitutions += i2 - i1
+        elif tag == "delete":
+            deletions += i2 - i1
+        elif tag == "insert":
+            insertions += j2 - j1
+
+    errors = substitutions + deletions + insertions
+    if len(reference_ids) == 0:
+        wer = insertions
+        mer = 0 if len(hypothesis_ids) == 0 else 1
+        wip = 1 if len(hypothesis_ids) == 0 else 0
+    else:
+        wer = errors / (hits + substitutions + deletions)
+        mer = errors / (hits + errors)
+        if len(hypothesis_ids) > 0:
+            wip = (hits / len(reference_ids)) * (hits / len(hypothesis_ids))
+        else:
+            wip = 0
+
+    return {
+        "wer": wer,
+        "mer": mer,
+        "wil": 1 - wip,
+        "wip": wip,
+        "hits": hits,
+        "substitutions": substitutions,
+        "insertions": insertions,
+        "deletions": deletions,
+    }
+
+
 def read_reference_file(path):
     if path.endswith(".txt"):
         return open(path, "r", encoding="utf-8-sig").read().splitlines()
@@ -110,21 +437,14 @@ def read_reference_file(path):
         raise Exception("Unknown reference transcription type {path}")
 
 
-def write_diff(druid, reference, hypothesis, diff_path):
-    from_lines = split_sentences(strip_rev_formatting(reference))
+def write_diff(druid, reference, hypothesis, diff_path, reference_sentences=None):
+    if reference_sentences is None:
+        reference_sentences = split_sentences(strip_rev_formatting(reference))
+    from_lines = reference_sentences
     to_lines = split_sentences(hypothesis)
 
-    diff = difflib.HtmlDiff(wrapcolumn=80)
-    diff = diff.make_file(from_lines, to_lines, "reference", "transcript")
-
-    html = StringIO()
-    html.writelines(diff)
-    html = html.getvalue()
-
-    # embed the media player for this item
-    html = html.replace(
-        "<body>",
-        f'<body style="margin: 0px;">\n\n    <div style="height: 200px;"><iframe style="position: fixed;" src="https://embed.stanford.edu/iframe?url=https://purl.stanford.edu/{druid}" height="200px" width="100%" title="Media viewer" frameborder="0" marginwidth="0" marginheight="0" scrolling="no" allowfullscreen="allowfullscreen" allow="clipboard-write"></iframe></div>',
+    html = diff_template.format(
+        druid=druid, rows="\n".join(diff_rows(from_lines, to_lines))
     )
 
     # write the diff file
@@ -133,6 +453,112 @@ def write_diff(druid, reference, hypothesis, diff_path):
     return html
 
 
+# this uses the same styles as difflib.HtmlDiff, which was used previously
+diff_template = """<!DOCTYPE html>
+<html>
+
+<head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+    <title></title>
+    <style type="text/css">
+        table.diff {{font-family:Courier; border:medium;}}
+        table.diff td {{white-space:pre-wrap; vertical-align:top; width:50%;}}
+        .diff_header {{background-color:#e0e0e0}}
+        td.diff_header {{text-align:right; width:auto;}}
+        .diff_add {{background-color:#aaffaa}}
+        .diff_chg {{background-color:#ffff77}}
+        .diff_sub {{background-color:#ffaaaa}}
+    </style>
+</head>
+
+<body style="margin: 0px;">
+
+    <div style="height: 200px;"><iframe style="position: fixed;" src="https://embed.stanford.edu/iframe?url=https://purl.stanford.edu/{druid}" height="200px" width="100%" title="Media viewer" frameborder="0" marginwidth="0" marginheight="0" scrolling="no" allowfullscreen="allowfullscreen" allow="clipboard-write"></iframe></div>
+
+    <table class="diff" cellspacing="0" cellpadding="0" rules="groups">
+        <thead><tr><th colspan="2" class="diff_header">reference</th><th colspan="2" class="diff_header">transcript</th></tr></thead>
+        <tbody>
+{rows}
+        </tbody>
+    </table>
+</body>
+
+</html>
+"""
+
+
+def diff_rows(from_lines, to_lines):
+    """
+    Generate the HTML table rows for a side by side diff of the lines. Lines
+    are aligned using their token ids, and words that differ in lines that
+    were changed are highlighted. Unlike difflib.HtmlDiff this is not
+    quadratic in the number of lines.
+    """
+    from_n = to_n = 0
+    line_ids = {}
+    from_ids = intern(from_lines, line_ids)
+    to_ids = intern(to_lines, line_ids)
+
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(from_ids, to_ids):
+        from_block = from_lines[i1:i2]
+        to_block = to_lines[j1:j2]
+        for k in range(max(len(from_block), len(to_block))):
+            from_line = from_block[k] if k < len(from_block) else None
+            to_line = to_block[k] if k < len(to_block) else None
+
+            if tag == "equal":
+                from_html = to_html = html.escape(from_line)
+            elif from_line is not None and to_line is not None:
+                from_html, to_html = diff_words(from_line, to_line)
+            else:
+                from_html = highlight(from_line, "diff_sub")
+                to_html = highlight(to_line, "diff_add")
+
+            from_n += from_line is not None
+            to_n += to_line is not None
+            yield (
+                f'            <tr><td class="diff_header">{from_n if from_line is not None else ""}</td>'
+                f"<td>{from_html}</td>"
+                f'<td class="diff_header">{to_n if to_line is not None else ""}</td>'
+                f"<td>{to_html}</td></tr>"
+            )
+
+
+def diff_words(from_line, to_line):
+    """
+    Return HTML for a pair of changed lines with the differing words highlighted.
+    """
+    from_words = from_line.split(" ")
+    to_words = to_line.split(" ")
+    word_table = {}
+    from_ids = intern(from_words, word_table)
+    to_ids = intern(to_words, word_table)
+
+    from_html = []
+    to_html = []
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(from_ids, to_ids):
+        from_text = " ".join(from_words[i1:i2])
+        to_text = " ".join(to_words[j1:j2])
+        if tag == "equal":
+            from_html.append(html.escape(from_text))
+            to_html.append(html.escape(to_text))
+        elif tag == "replace":
+            from_html.append(highlight(from_text, "diff_chg"))
+            to_html.append(highlight(to_text, "diff_chg"))
+        elif tag == "delete":
+            from_html.append(highlight(from_text, "diff_sub"))
+        elif tag == "insert":
+            to_html.append(highlight(to_text, "diff_add"))
+
+    return " ".join(from_html), " ".join(to_html)
+
+
+def highlight(text, css_class):
+    if text is None:
+        return ""
+    return f'<span class="{css_class}">{html.escape(text)}</span>'
+
+
 def parse_google(data):
     lines = [result["alternatives"][0]["transcript"] for result in data["results"]]
     lang_counts = Counter([result["languageCode"] for result in data["results"]])
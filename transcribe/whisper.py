@@ -1,20 +1,32 @@
+import glob
+import hashlib
+import heapq
 import json
 import logging
+import multiprocessing
 import os
-import re
-import shlex
-import subprocess
-import tempfile
+import queue
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
-from functools import lru_cache
-from itertools import product
+from itertools import groupby, product
 
+import numpy
 import torch
 import tqdm
 import whisper
-from pydub import AudioSegment
 
-from . import utils
+from . import cache, daemon, pcm, utils
+
+# check for CUDA with NVML rather than by initializing it, since worker
+# processes forked after CUDA is initialized can't use it
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
 
 # These are whisper options that we want to perturb.
 #
@@ -32,6 +44,13 @@ whisper_options = {
     "best_of": [5, 10],
 }
 
+# model names ending with this are quantized to int8, see load_int8_model
+INT8_SUFFIX = "-int8"
+
+# the number of models load_model keeps in memory, see daemon.py
+MAX_MODELS = 1
+models = {}
+
 preprocessing_combinations = [
     "afftdn=nr=10:nf=-25:tn=1",
     "afftdn=nr=10:nf=-25:tn=1,volume=4",
@@ -42,100 +61,534 @@ preprocessing_combinations = [
 ]
 
 
-def run(output_dir, manifest):
-    combinations = list(whisper_option_combinations())
+def run(
+    output_dir,
+    manifest,
+    workers=1,
+    resume=False,
+    batch_size=None,
+    durations=None,
+    history=None,
+    reuse_encoder=False,
+    int8=False,
+):
+    combinations = list(whisper_option_combinations(batch_size, reuse_encoder, int8))
     files = utils.get_data_files(manifest)
-    total = len(combinations) * len(files)
-    progress = tqdm.tqdm(total=total, desc="whisper".ljust(10))
+    runs = plan_runs(files, combinations)
+    if durations is not None:
+        runs = schedule(runs, durations, output_dir, workers, history)
 
-    results = []
-    for file_metadata in files:
-        for options in combinations:
-            file_metadata["run_count"] = len(results) + 1
-            result = run_whisper(file_metadata, options, output_dir)
-            results.append(result)
-            progress.update(1)
+    results = execute(runs, output_dir, workers, desc="whisper", resume=resume)
 
     csv_filename = os.path.join(output_dir, "report-whisper.csv")
-    utils.write_report(results, csv_filename, extra_cols=["options"])
+    utils.write_report(
+        results, csv_filename, extra_cols=["options", *utils.profile_csv_columns]
+    )
 
 
-def run_preprocessing(output_dir, manifest):
-    results = []
+def run_search(
+    output_dir,
+    manifest,
+    workers=1,
+    resume=False,
+    batch_size=None,
+    durations=None,
+    history=None,
+    eta=3,
+    reuse_encoder=False,
+    int8=False,
+):
+    """
+    Like run, but rather than running every combination of whisper options on
+    every file, use successive_halving to weed out the combinations that do
+    badly on a few files before running the rest on all of them.
+    """
+    combinations = list(whisper_option_combinations(batch_size, reuse_encoder, int8))
     files = utils.get_data_files(manifest)
-    total = len(files) * len(preprocessing_combinations)
-    progress = tqdm.tqdm(total=total, desc="preprocess".ljust(10))
+    runs = plan_runs(files, combinations)
+
+    def execute_rung(rung_runs, desc):
+        if durations is not None:
+            rung_runs = schedule(rung_runs, durations, output_dir, workers, history)
+        return execute(rung_runs, output_dir, workers, desc=desc, resume=resume)
+
+    results = successive_halving(runs, execute_rung, eta)
 
+    csv_filename = os.path.join(output_dir, "report-whisper.csv")
+    utils.write_report(
+        results, csv_filename, extra_cols=["options", *utils.profile_csv_columns]
+    )
+
+
+def successive_halving(runs, execute_rung, eta=3, min_files=1):
+    """
+    Run the combinations of options in the (file_metadata, options) runs on a
+    growing number of files, keeping the best 1/eta of them by mean WER after
+    each round (rung), until the survivors have been run on all of the files.
+    The first rung uses min_files files and each rung after that uses eta
+    times as many. execute_rung is called with the runs for each rung and a
+    description, and should return their results in run_count order. The
+    results of all the runs, including those of the combinations that were
+    dropped, are returned in run_count order.
+    """
+    druids = list(dict.fromkeys(file_metadata["druid"] for file_metadata, _ in runs))
+    candidates = list(dict.fromkeys(options_key(options) for _, options in runs))
+
+    results = {}
+    file_count = min(min_files, len(druids))
+    rung = 0
+    while True:
+        subset = set(druids[:file_count])
+        pending = [
+            (file_metadata, options)
+            for file_metadata, options in runs
+            if file_metadata["druid"] in subset
+            and options_key(options) in candidates
+            and file_metadata["run_count"] not in results
+        ]
+        run_counts = sorted(file_metadata["run_count"] for file_metadata, _ in pending)
+        for run_count, result in zip(run_counts, execute_rung(pending, f"rung {rung}")):
+            results[run_count] = result
+
+        if file_count == len(druids):
+            break
+
+        # score the candidates on the files they've all been run on
+        wers = {key: [] for key in candidates}
+        for file_metadata, options in runs:
+            key = options_key(options)
+            if key in wers and file_metadata["druid"] in subset:
+                wers[key].append(float(results[file_metadata["run_count"]]["wer"]))
+        ranked = sorted(candidates, key=lambda key: numpy.mean(wers[key]))
+        keep = max(1, -(-len(candidates) // eta))
+        logging.info(
+            "rung %s kept %s of %s option combinations on %s files, best was %s",
+            rung,
+            keep,
+            len(candidates),
+            file_count,
+            ranked[0],
+        )
+        candidates = ranked[:keep]
+
+        file_count = min(file_count * eta, len(druids))
+        rung += 1
+
+    return [results[run_count] for run_count in sorted(results)]
+
+
+def options_key(options):
+    return json.dumps(options, sort_keys=True)
+
+
+def plan_runs(files, combinations):
+    """
+    Order the (file x options) matrix so that all the runs for a given model
+    happen together, since loading a model takes a long time and only one is
+    kept in memory at a time. Models are visited in the order they first appear
+    in the combinations, and within a model the original file-major order is
+    kept. Each file_metadata is copied with the run_count it would have had if
+    the matrix was run in file-major order, so run ids stay the same.
+    """
+    runs = []
     for file_metadata in files:
-        for combination in preprocessing_combinations:
-            file = file_metadata["media_filename"]
-            logging.info("preprocessing for file %s: %s", file, combination)
-            preprocessed_file = (
-                os.path.basename(file).rsplit(".", 1)[0]
-                + "_filter_"
-                + re.sub(r"[^A-Za-z0-9]", "", combination)
-                + ".wav"
+        for options in combinations:
+            run_count = len(runs) + 1
+            runs.append(({**file_metadata, "run_count": run_count}, options))
+
+    model_names = list(dict.fromkeys(options["model_name"] for options in combinations))
+    runs.sort(key=lambda run: model_names.index(run[1]["model_name"]))
+
+    return runs
+
+
+def schedule(runs, durations, output_dir, workers=1, history=None):
+    """
+    Order the runs longest first using the durations of the media (seconds
+    keyed by druid) and the real-time factors measured for each model in the
+    ledgers of previous runs. By default these are the output_dir and the
+    other output-* directories next to it. The estimated time the runs will
+    take with the given number of workers is logged.
+    """
+    if history is None:
+        parent = os.path.dirname(os.path.abspath(output_dir))
+        history = [output_dir, *glob.glob(os.path.join(parent, "output-*"))]
+    rtfs = measure_rtfs(history, durations)
+    runs = order_runs(runs, durations, rtfs)
+
+    costs = [estimate_cost(run, durations, rtfs) for run in runs]
+    hours = estimate_makespan(costs, workers) / 3600
+    logging.info("rtfs %s, estimated %.1f hours with %s workers", rtfs, hours, workers)
+
+    return runs
+
+
+def order_runs(runs, durations, rtfs):
+    """
+    Reorder model-major runs so that the most expensive work starts first,
+    which keeps a long file at the end of a worker's queue from holding up the
+    whole sweep. Runs for a model stay together so that each worker only loads
+    each model once, but the models with the most work go first and within a
+    model the runs are ordered longest first.
+    """
+    groups = {}
+    for run in runs:
+        groups.setdefault(run[1]["model_name"], []).append(run)
+
+    def cost(run):
+        return estimate_cost(run, durations, rtfs)
+
+    ordered = []
+    for group in sorted(groups.values(), key=lambda g: -sum(map(cost, g))):
+        ordered.extend(sorted(group, key=cost, reverse=True))
+
+    return ordered
+
+
+def estimate_cost(run, durations, rtfs):
+    """
+    Estimate how many seconds a run will take. Media without a known duration
+    is assumed to be as long as the longest that is known, so that it isn't
+    left until the end.
+    """
+    file_metadata, options = run
+    default = max(durations.values(), default=3600)
+    duration = durations.get(file_metadata["druid"], default)
+    return duration * rtfs.get(options["model_name"], 1.0)
+
+
+def estimate_makespan(costs, workers):
+    """
+    Return how long it will take for the workers to get through the costs if
+    each picks up the next one in order as soon as it is free.
+    """
+    finish_times = [0.0] * max(1, workers)
+    for cost in costs:
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+
+def measure_rtfs(output_dirs, durations):
+    """
+    Return the real-time factor (runtime divided by audio duration) for each
+    model from the whisper runs in the ledgers of the output_dirs. Results
+    without an audio_duration use the durations keyed by druid.
+    """
+    totals = {}
+    for output_dir in set(map(os.path.abspath, output_dirs)):
+        for key, result in utils.read_ledger(output_dir).items():
+            druid, engine, options = json.loads(key)
+            duration = result.get("audio_duration") or durations.get(druid)
+            if engine != "whisper" or not duration or "runtime" not in result:
+                continue
+            runtime, total = totals.get(options["model_name"], (0.0, 0.0))
+            totals[options["model_name"]] = (
+                runtime + result["runtime"],
+                total + duration,
             )
-            subprocess.Popen(
-                f"ffmpeg -i {file} -af {combination} {preprocessed_file}",
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            ).communicate()
-            result = run_whisper(
-                {
-                    **file_metadata,
-                    "media_filename": preprocessed_file,
-                    "run_count": len(results) + 1,
-                },
-                {
-                    "model_name": "large",
-                    "beam_size": 5,
-                    "patience": 1,
-                    "condition_on_previous_text": True,
-                },
-                output_dir,
+
+    return {model: runtime / total for model, (runtime, total) in totals.items()}
+
+
+def run_preprocessing(
+    output_dir,
+    manifest,
+    workers=1,
+    resume=False,
+    batch_size=None,
+    durations=None,
+    history=None,
+):
+    files = utils.get_data_files(manifest)
+    options = {
+        "model_name": "large",
+        "beam_size": 5,
+        "patience": 1,
+        "condition_on_previous_text": True,
+    }
+    if batch_size:
+        options["batch_size"] = batch_size
+
+    runs = []
+    for file_metadata in files:
+        for combination in preprocessing_combinations:
+            run_count = len(runs) + 1
+            runs.append(
+                (
+                    {**file_metadata, "run_count": run_count, "filters": combination},
+                    options,
+                )
             )
-            result["ffmpeg filer"] = combination
-            logging.info("result %s", result)
-            results.append(result)
 
-            os.remove(preprocessed_file)
-            progress.update(1)
+    if durations is not None:
+        runs = schedule(runs, durations, output_dir, workers, history)
+
+    results = execute(runs, output_dir, workers, desc="preprocess", resume=resume)
 
     csv_filename = os.path.join(output_dir, "report-whisper-preprocessing.csv")
-    utils.write_report(results, csv_filename, extra_cols=["ffmpeg filer"])
+    utils.write_report(
+        results, csv_filename, extra_cols=["ffmpeg filer", *utils.profile_csv_columns]
+    )
+
+
+def execute(runs, output_dir, workers=1, desc="whisper", resume=False):
+    """
+    Run whisper for a list of (file_metadata, options) runs and return the
+    results in run_count order. If workers is more than one the runs are
+    spread across a pool of processes, which pick up the runs in the order
+    they are given. Each run of runs with the same model gets its own pool,
+    which is forked after the model has been loaded (see share_model) so the
+    workers share one copy of it. The available CPUs are divided between the
+    workers so that torch doesn't oversubscribe them. With one worker the
+    runs happen in this process, overlapping decoding, transcription and
+    writing out the results (see pipeline).
+
+    Each finished run is recorded in the ledger in the output_dir, and if
+    resume is True runs that are already in the ledger are skipped.
+    """
+    progress = tqdm.tqdm(total=len(runs), desc=desc.ljust(10))
+    results = {}
+
+    ledger = utils.read_ledger(output_dir) if resume else {}
+    keys = {}
+    pending = []
+    for file_metadata, options in runs:
+        key = get_ledger_key(file_metadata, options)
+        if key in ledger:
+            results[file_metadata["run_count"]] = ledger[key]
+            progress.update(1)
+        else:
+            keys[file_metadata["run_count"]] = key
+            pending.append((file_metadata, options))
+    runs = pending
+
+    def finish(run_count, result):
+        utils.append_ledger(output_dir, keys[run_count], result)
+        results[run_count] = result
+        progress.update(1)
+
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        # each model gets its own pool of workers, forked after the model has
+        # been loaded so that they share it
+        for model_name, model_runs in groupby(runs, lambda run: run[1]["model_name"]):
+            share_model(model_name)
+            # fork since the run script can't be safely re-imported by spawn
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=torch.set_num_threads,
+                initargs=(threads,),
+            ) as pool:
+                futures = {
+                    pool.submit(run_whisper, file_metadata, options, output_dir): (
+                        file_metadata["run_count"]
+                    )
+                    for file_metadata, options in model_runs
+                }
+                error = None
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # record the runs that do finish before giving up
+                        error = error or e
+                        continue
+                    finish(futures[future], result)
+                if error is not None:
+                    raise error
+    else:
+        for run_count, result in pipeline(runs, output_dir):
+            finish(run_count, result)
+
+    return [results[run_count] for run_count in sorted(results)]
+
+
+def share_model(model_name):
+    """
+    Load the model in this process with its weights in shared memory, so that
+    worker processes forked afterwards use the same copy of them rather than
+    loading their own. This isn't done if the transcription happens in a
+    daemon, or with CUDA, which doesn't work in forked processes.
+    """
+    if os.environ.get("WHISPER_PILOT_DAEMON") or torch.cuda.is_available():
+        return
+
+    model = load_model(model_name)
+    # the alignment_heads buffer is sparse, which can't be shared, but it's small
+    for tensor in [*model.parameters(), *model.buffers()]:
+        if not tensor.is_sparse:
+            tensor.share_memory_()
+
+
+def get_ledger_key(file_metadata, options):
+    # reusing encoder output doesn't change the results
+    options = {k: v for k, v in options.items() if k != "reuse_encoder"}
+    if file_metadata.get("filters"):
+        options = {**options, "filters": file_metadata["filters"]}
+    return utils.ledger_key(file_metadata["druid"], "whisper", options)
 
 
 def run_whisper(file_metadata, options, output_dir):
     start_time = datetime.now()
     file = file_metadata["media_filename"]
     logging.info("running whisper on %s with options %s", file, options)
-    transcription = transcribe(file_metadata, options)
+    metrics = {}
+    transcription = transcribe(file_metadata, options, metrics)
     runtime = utils.get_runtime(start_time)
 
+    return write_result(
+        file_metadata, options, output_dir, transcription, runtime, metrics
+    )
+
+
+def write_result(file_metadata, options, output_dir, transcription, runtime, metrics):
+    """
+    Compare the transcription with the reference transcript, write out the
+    diff and the transcription JSON, and return the result for the report.
+    """
     result = utils.compare_transcripts(
-        file_metadata, transcription, "whisper", output_dir
+        file_metadata, transcription, "whisper", output_dir, metrics
     )
 
     result["druid"] = file_metadata["druid"]
     result["runtime"] = runtime
     result["options"] = str(options)
+    if file_metadata.get("filters"):
+        result["ffmpeg filer"] = file_metadata["filters"]
 
     # write out the json results
-    with open(os.path.join(output_dir, f"{result['run_id']}.json"), "w") as fh:
-        json.dump(transcription, fh, ensure_ascii=False)
+    with utils.timed(metrics, "write"):
+        with open(os.path.join(output_dir, f"{result['run_id']}.json"), "w") as fh:
+            json.dump(transcription, fh, ensure_ascii=False)
+
+    # the real-time factor only counts inference, since model loading and
+    # decoding are mostly cached and would otherwise skew it
+    if metrics.get("audio_duration"):
+        metrics["rtf"] = metrics["inference_time"] / metrics["audio_duration"]
+    metrics["peak_rss_mb"] = utils.peak_rss()
+    metrics.update(utils.memory_usage())
+    metrics["worker_pid"] = os.getpid()
+    result.update(metrics)
 
     logging.info("result: %s", result)
     return result
 
 
-def transcribe(file_metadata, options):
-    model = load_model(options["model_name"])
+def pipeline(runs, output_dir, prefetch=2, writers=2):
+    """
+    Run whisper on the (file_metadata, options) runs in this process, and
+    yield (run_count, result) as each one finishes. So that the model is never
+    waiting on anything else, a thread decodes the audio for up to prefetch
+    files ahead into the cache, and comparing the transcriptions and writing
+    out the results happens in a pool of writer threads while the next run is
+    transcribed. At most twice as many runs as there are writers wait to be
+    written before transcription pauses for them to catch up.
+    """
+    decoded = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(run):
+        # wait until the runs have caught up, or give up if they've stopped
+        while not stop.is_set():
+            try:
+                decoded.put(run, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def decode():
+        previous = None
+        for file_metadata, options in runs:
+            audio_key = (
+                file_metadata.get("media_filename"),
+                file_metadata.get("filters"),
+            )
+            if audio_key != previous and not stop.is_set():
+                try:
+                    load_audio(*audio_key)
+                except Exception:
+                    # the run will fail with the error when it loads the audio,
+                    # this thread mustn't stop or the runs would wait forever
+                    logging.exception("unable to prefetch %s", audio_key[0])
+                previous = audio_key
+            put((file_metadata, options))
+        put(None)
+
+    threading.Thread(target=decode, daemon=True).start()
+
+    writing = {}
+    try:
+        with ThreadPoolExecutor(max_workers=writers) as pool:
+            while (run := decoded.get()) is not None:
+                file_metadata, options = run
+                start_time = datetime.now()
+                file = file_metadata["media_filename"]
+                logging.info("running whisper on %s with options %s", file, options)
+                metrics = {}
+                try:
+                    transcription = transcribe(file_metadata, options, metrics)
+                except Exception:
+                    # hand back the runs that were already transcribed so
+                    # they are recorded before giving up
+                    for future in as_completed(list(writing)):
+                        yield writing.pop(future), future.result()
+                    raise
+                runtime = utils.get_runtime(start_time)
+
+                future = pool.submit(
+                    write_result,
+                    file_metadata,
+                    options,
+                    output_dir,
+                    transcription,
+                    runtime,
+                    metrics,
+                )
+                writing[future] = file_metadata["run_count"]
+
+                # hand back whatever has been written, waiting if the writers
+                # have fallen behind
+                timeout = None if len(writing) >= writers * 2 else 0
+                done, _ = wait(writing, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield writing.pop(future), future.result()
+
+            for future in as_completed(list(writing)):
+                yield writing.pop(future), future.result()
+    finally:
+        stop.set()
+
+
+def transcribe(file_metadata, options, metrics=None, use_daemon=True):
+    """
+    Transcribe the file with whisper using the given options. If a metrics
+    dict is supplied the time spent loading the model, decoding the audio and
+    running inference is added to it, along with the duration of the audio
+    and the number of threads torch used. If the WHISPER_PILOT_DAEMON
+    environment variable is the path of a daemon's socket the transcription
+    happens in the daemon instead, unless use_daemon is False.
+    """
+    # send the work to the daemon if there is one, where the model is warm
+    socket_path = os.environ.get("WHISPER_PILOT_DAEMON")
+    if socket_path and use_daemon:
+        return daemon.request(socket_path, file_metadata, options, metrics)
+
+    with utils.timed(metrics, "load_model"):
+        model = load_model(options["model_name"])
 
     whisper_options = options.copy()
     whisper_options.pop("model_name")
 
+    # the encoder output only depends on the model and the audio, so it can be
+    # shared by runs whose options only change the decoding. That only works
+    # when batching, since otherwise each 30 second window starts where the
+    # text decoded from the previous one ended, which differs between runs
+    reuse_encoder = whisper_options.pop("reuse_encoder", False)
+    cache_encoder(
+        model, options["model_name"], reuse_encoder and bool(options.get("batch_size"))
+    )
+
     # if the languages of the source media and transcript are different and the
     # transcript is to be in English then we tell Whisper to translate
     if (
@@ -145,88 +598,387 @@ def transcribe(file_metadata, options):
         whisper_options["task"] = "translate"
 
     whisper_options["language"] = file_metadata["media_language"]
-    audio = load_audio(file_metadata["media_filename"])
+    with utils.timed(metrics, "decode"):
+        audio = load_audio(
+            file_metadata["media_filename"], file_metadata.get("filters")
+        )
+
+    if metrics is not None:
+        metrics["audio_duration"] = len(audio) / pcm.SAMPLE_RATE
+        metrics["torch_threads"] = torch.get_num_threads()
+
+    with utils.timed(metrics, "inference"):
+        # a batch_size option switches to transcribing chunks of speech in batches
+        batch_size = whisper_options.pop("batch_size", None)
+        if batch_size:
+            duration = len(audio) / pcm.SAMPLE_RATE
+            chunks = speech_chunks(find_silences(audio), duration)
+            return transcribe_chunks(
+                model, audio, chunks, batch_size, **whisper_options
+            )
+
+        # unlike the batched mode this isn't constant memory, since whisper
+        # copies all the audio into a tensor and makes its log-mel spectrogram
+        # up front, which takes several hundred MB for each hour of audio
+        return whisper.transcribe(audio=audio, model=model, **whisper_options)
+
+
+def speech_chunks(silences, duration, max_length=30):
+    """
+    Split audio of the given duration into (start, end) chunks of up to
+    max_length seconds, cutting in the middle of silences where possible so
+    that words aren't cut in half. Chunks that are entirely silent are left
+    out.
+    """
+    cuts = (silences["start"] + silences["end"]) / 2
+
+    chunks = []
+    start = 0.0
+    while duration - start > 0.01:
+        end = min(start + max_length, duration)
+        if end < duration:
+            # cut at the last silence in the window, or the end if there isn't one
+            candidates = cuts[(cuts > start + 1) & (cuts <= end)]
+            if len(candidates) > 0:
+                end = float(candidates[-1])
+
+        silent = numpy.any((silences["start"] <= start) & (silences["end"] >= end))
+        if not silent:
+            chunks.append((start, end))
+        start = end
+
+    return chunks
+
+
+def transcribe_chunks(
+    model,
+    audio,
+    chunks,
+    batch_size,
+    language=None,
+    task="transcribe",
+    beam_size=None,
+    patience=None,
+    best_of=None,
+    condition_on_previous_text=None,
+):
+    """
+    Transcribe the (start, end) chunks of the audio, decoding batch_size chunks
+    at once, and return the result in the same form as whisper.transcribe with
+    the segment times relative to the start of the audio. Since the chunks are
+    decoded independently condition_on_previous_text has no effect, and like
+    whisper.transcribe best_of is only used when sampling, which this doesn't
+    do.
+    """
+    decode_options = whisper.DecodingOptions(
+        task=task,
+        language=language,
+        beam_size=beam_size,
+        patience=patience,
+        fp16=model.device.type == "cuda",
+    )
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual,
+        num_languages=model.num_languages,
+        language=language,
+        task=task,
+    )
+
+    segments = []
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i : i + batch_size]
+        mels = torch.stack(
+            [get_mel(audio, start, end, model.dims.n_mels) for start, end in batch]
+        )
+        decoding_task = BatchDecodingTask(model, decode_options)
+        results = decoding_task.run(mels.to(model.device))
+
+        for (start, end), result in zip(batch, results):
+            # skip chunks that the model thinks are not speech, like whisper does
+            if result.no_speech_prob > 0.6 and result.avg_logprob < -1:
+                continue
+            for seg_start, seg_end, tokens in split_segments(
+                result.tokens, tokenizer, end - start
+            ):
+                segments.append(
+                    {
+                        "id": len(segments),
+                        "seek": int(start * pcm.SAMPLE_RATE / whisper.audio.HOP_LENGTH),
+                        "start": round(start + seg_start, 2),
+                        "end": round(start + seg_end, 2),
+                        "text": tokenizer.decode(tokens),
+                        "tokens": tokens,
+                        "temperature": result.temperature,
+                        "avg_logprob": result.avg_logprob,
+                        "compression_ratio": result.compression_ratio,
+                        "no_speech_prob": result.no_speech_prob,
+                    }
+                )
+
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": language,
+    }
+
+
+class BatchDecodingTask(whisper.decoding.DecodingTask):
+    """
+    Since openai-whisper 20250625 the decoding task doesn't repeat the audio
+    features for each beam of a beam search, which only works when decoding
+    a single window. This repeats them so that a batch of windows can be
+    decoded with a beam search.
+    """
+
+    def _get_audio_features(self, mel):
+        audio_features = super()._get_audio_features(mel)
+        return audio_features.repeat_interleave(self.n_group, dim=0)
+
+    def _detect_language(self, audio_features, tokens):
+        return super()._detect_language(audio_features[:: self.n_group], tokens)
+
+
+def get_mel(audio, start, end, n_mels):
+    """
+    Return the log mel spectrogram for a chunk of audio, padded to 30 seconds.
+    """
+    clip = audio[int(start * pcm.SAMPLE_RATE) : int(end * pcm.SAMPLE_RATE)]
+    return whisper.log_mel_spectrogram(
+        whisper.pad_or_trim(numpy.asarray(clip)), n_mels=n_mels
+    )
 
-    return whisper.transcribe(audio=audio, model=model, **whisper_options)
+
+def split_segments(tokens, tokenizer, duration):
+    """
+    Split the decoded tokens for a chunk into (start, end, text tokens)
+    segments using the timestamp tokens. Text without a closing timestamp
+    runs to the end of the chunk, and text without an opening timestamp starts
+    where the previous segment ended.
+    """
+    segments = []
+    start = None
+    end = 0.0
+    text_tokens = []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            time = (token - tokenizer.timestamp_begin) * 0.02
+            if start is not None and len(text_tokens) > 0:
+                segments.append((start, time, text_tokens))
+                start = None
+                end = time
+                text_tokens = []
+            else:
+                start = time
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+
+    if len(text_tokens) > 0:
+        segments.append((end if start is None else start, duration, text_tokens))
+
+    return segments
 
 
 def get_language(file, model_name):
+    return get_languages([file], model_name)[0]
+
+
+def detect_languages(manifest, model_name="large-v3", batch_size=16):
+    """
+    Detect the language of the media in each row of the manifest, returning a
+    list of language codes in the same order as the rows.
+    """
+    files = [row["media_filename"] for row in utils.get_data_files(manifest)]
+    return get_languages(files, model_name, batch_size)
+
+
+def get_languages(files, model_name, batch_size=16):
+    """
+    Detect the languages for a list of media files. The 30 seconds after any
+    initial silence is taken from each file's decoded audio, and their mel
+    spectrograms are stacked so that the model detects the language for
+    batch_size files at a time.
+    """
     model = load_model(model_name)
-    silences = get_silences(file)
-    n_mels = 128 if model_name == "large" else 80
-
-    if len(silences) > 0 and int(silences[0]["start_silence"]) == 0:
-        audio_segment = AudioSegment.from_file(file)
-        start_time = silences[0]["end_silence"] * 1000
-        end_time = (30 + silences[0]["end_silence"]) * 1000
-        clip = audio_segment[start_time:end_time]
-        with tempfile.NamedTemporaryFile() as tmp:
-            clip.export(tmp.name, format="wav")
-            audio = load_audio(tmp.name)
-    else:
-        audio = load_audio(file)
 
-    audioclip = whisper.pad_or_trim(audio)
-    mel = whisper.log_mel_spectrogram(audioclip, n_mels=n_mels).to(model.device)
-    _, probs = model.detect_language(mel)
+    languages = []
+    for i in range(0, len(files), batch_size):
+        mels = [
+            whisper.log_mel_spectrogram(get_speech_clip(file), n_mels=model.dims.n_mels)
+            for file in files[i : i + batch_size]
+        ]
+        _, probs = model.detect_language(torch.stack(mels).to(model.device))
+        languages.extend(max(p, key=p.get) for p in probs)
 
-    return max(probs, key=probs.get)
+    return languages
 
 
-def get_silences(file):
-    file = shlex.quote(file)
-    p = subprocess.Popen(
-        "ffmpeg -i {} -af 'volumedetect' -vn -sn -dn -f null /dev/null".format(file),
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    ).communicate()
-    detectvolume = p[-1].decode("utf-8")
-    meanvolume = ffmpegcontentparse(detectvolume, "mean_volume")
-    volume = meanvolume - 1 if meanvolume > -37 else -37
-    p2 = subprocess.Popen(
-        "ffmpeg -i {} -af silencedetect=n={}dB:d=0.5 -f null -".format(file, volume),
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    ).communicate()
-    startendsilences = []
-    for item in p2[-1].decode("utf-8").split("\n"):
-        if "silence_start" in item:
-            startendsilences.append(
-                {"start_silence": ffmpegcontentparse(item, "silence_start")}
-            )
-        elif "silence_end" in item:
-            startendsilences[-1] = startendsilences[-1] | {
-                "end_silence": ffmpegcontentparse(item.split("|")[0], "silence_end"),
-                "duration": ffmpegcontentparse(item, "silence_duration"),
-            }
+def get_speech_clip(file):
+    """
+    Return 30 seconds of audio from the file, skipping any initial silence.
+    """
+    audio = load_audio(file)
+    silences = get_silences(file)
+    if len(silences) > 0 and int(silences["start"][0]) == 0:
+        start = int(silences["end"][0] * pcm.SAMPLE_RATE)
+        audio = audio[start : start + 30 * pcm.SAMPLE_RATE]
+
+    return whisper.pad_or_trim(numpy.asarray(audio))
 
-    return startendsilences
+
+def get_silences(file):
+    """
+    Return an array of pcm.SILENCE intervals for the file. The silence
+    threshold is just below the mean volume of the file, but no lower than
+    -37 dB. Both are worked out from the cached decoded audio, so the file
+    is decoded at most once.
+    """
+    return find_silences(load_audio(file))
 
 
-def ffmpegcontentparse(content, field):
-    lines = content.split("\n")
-    correctline = [idx for idx, s in enumerate(lines) if field in s][0]
-    get_value = lines[correctline].split(":")[-1]
-    value_as_float = float(re.sub(r"[^0-9\-.]", "", get_value, 0, re.MULTILINE).strip())
-    return value_as_float
+def find_silences(audio):
+    meanvolume = pcm.mean_volume(audio)
+    volume = meanvolume - 1 if meanvolume > -37 else -37
+    return pcm.detect_silences(audio, volume)
+
+
+def cache_encoder(model, model_name, enabled=True):
+    """
+    Turn caching of the model's encoder output on or off, see CachedEncoder.
+    """
+    if enabled and not isinstance(model.encoder, CachedEncoder):
+        model.encoder = CachedEncoder(model.encoder, model_name)
+    elif not enabled and isinstance(model.encoder, CachedEncoder):
+        model.encoder = model.encoder.encoder
+
+
+class CachedEncoder(torch.nn.Module):
+    """
+    A wrapper for a whisper model's audio encoder that keeps the encoder output
+    for each 30 second log-mel window in the "features" cache. The output is
+    keyed by the model name and the content of the window, so transcribing the
+    same chunks of audio again with different beam_size, patience, best_of or
+    condition_on_previous_text options, in this or another process, reads the
+    encoder output from the cache rather than running the encoder again, even
+    when the runs happen at the same time in different worker processes.
+    """
+
+    def __init__(self, encoder, model_name):
+        super().__init__()
+        self.encoder = encoder
+        self.model_name = model_name
+
+    def forward(self, mel):
+        keys = []
+        for window in mel:
+            digest = hashlib.sha256(numpy.ascontiguousarray(window.cpu().numpy()))
+            keys.append(cache.make_key(self.model_name, digest.hexdigest()))
+        features = [cache.load("features", key) for key in keys]
+
+        if any(feature is None for feature in features):
+            # workers running the other decoding options get to the same
+            # windows at the same time, so they wait for the first of them to
+            # encode the windows and then read its output from the cache
+            with cache.lock(cache.make_key(*keys)):
+                features = [cache.load("features", key) for key in keys]
+                missing = [i for i, feature in enumerate(features) if feature is None]
+                if missing:
+                    encoded = self.encoder(mel[missing])
+                    for i, feature in zip(missing, encoded):
+                        feature = feature.detach().cpu().numpy()
+                        features[i] = cache.save("features", keys[i], feature)
+
+        features = torch.stack([torch.from_numpy(feature) for feature in features])
+        return features.to(mel.device)
 
 
-@lru_cache(maxsize=1)
 def load_model(model_name):
-    # cache the response since it takes some time to load
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    return whisper.load_model(model_name, device=device)
+    """
+    Return the named whisper model. The most recently used MAX_MODELS models
+    are kept in memory since they take some time to load, but they are big so
+    usually that's just one.
+    """
+    if model_name in models:
+        # move it to the end as the most recently used
+        models[model_name] = models.pop(model_name)
+    else:
+        while models and len(models) >= MAX_MODELS:
+            models.pop(next(iter(models)))
+        if model_name.endswith(INT8_SUFFIX):
+            model = load_int8_model(model_name.removesuffix(INT8_SUFFIX))
+        else:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model = whisper.load_model(model_name, device=device)
+        models[model_name] = model
+
+    return models[model_name]
+
+
+def load_int8_model(model_name):
+    """
+    Return the named model with its linear layers dynamically quantized to
+    int8, which makes it smaller and faster on CPUs at some cost to accuracy.
+    Quantized models only run on the CPU. The quantized model is saved in the
+    cache so it is only quantized once.
+    """
+    key = cache.make_key(model_name, whisper.__version__, torch.__version__)
+    path = os.path.join(cache.get_dir("models"), f"{key}-int8.pt")
+    if os.path.isfile(path):
+        # this is a file we saved, so it is safe to unpickle
+        return torch.load(path, weights_only=False)
+
+    model = quantize_int8(whisper.load_model(model_name, device="cpu"))
+    tmp_path = f"{path}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+
+    return model
+
+
+def quantize_int8(model):
+    # quantize_dynamic only recognizes torch's Linear, not whisper's subclass of
+    # it, which only differs in casting the weights to the input's dtype
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, whisper.model.Linear):
+                linear = torch.nn.Linear(
+                    child.in_features, child.out_features, bias=child.bias is not None
+                )
+                linear.load_state_dict(child.state_dict())
+                setattr(module, name, linear)
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
 
+def load_audio(file, filters=None):
+    # decoded audio is cached on disk, see pcm.load. The file is decoded once
+    # for all the preprocessing filter chains, just before its first run with
+    # one of them rather than all files up front, which could push the earlier
+    # files out of the cache before they are used
+    if filters in preprocessing_combinations:
+        i = preprocessing_combinations.index(filters)
+        return pcm.load_filtered(file, preprocessing_combinations)[i]
+    return pcm.load(file, filters)
 
-@lru_cache(maxsize=1)
-def load_audio(file):
-    return whisper.load_audio(file)
 
+def whisper_option_combinations(batch_size=None, reuse_encoder=False, int8=False):
+    # optionally try int8 quantized versions of the models too
+    option_values = dict(whisper_options)
+    if int8:
+        option_values["model_name"] = [
+            name
+            for model_name in whisper_options["model_name"]
+            for name in [model_name, model_name + INT8_SUFFIX]
+        ]
 
-def whisper_option_combinations():
     # generate a list of all possible combinations of the whisper option values
-    for values in product(*whisper_options.values()):
+    for values in product(*option_values.values()):
         # generate a dict using the combination values and the original keys
-        yield dict(zip(whisper_options.keys(), values))
+        options = dict(zip(option_values.keys(), values))
+        # and the options for how the transcription is done
+        if batch_size:
+            options["batch_size"] = batch_size
+        if reuse_encoder:
+            options["reuse_encoder"] = True
+        yield options